@@ -0,0 +1,416 @@
+#!/usr/bin/python
+
+'''
+module name: Benchmark
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import sqlite3
+import argparse
+import datetime
+import resource
+import tempfile
+import platform
+import multiprocessing
+import numpy as np
+from ObservationalData import LongitudeObservationalDatabase
+from ObservationalData import MedicalRecord
+from ObservationalData import read_id_medical_records_hash_map
+from ObservationalData import write_id_medical_records_hash_map
+from DrugConditionSignal import UnexpectedDrugConditionSignal
+from DrugConditionSignal import write_hash_map_to_file
+from DrugConditionSignal import write_drug_condition_pair_table_to_file
+from DrugConditionSignal import write_leverage_table_to_file
+from Metrics import Metrics
+
+
+class SyntheticObservationalDatabase(LongitudeObservationalDatabase):
+
+    # LongitudeObservationalDatabase over a sqlite3 file with the same tables, e.g. one written by write_synthetic_database
+
+    def __init__(self, file_path, **options):
+        self.__file_path = file_path
+        LongitudeObservationalDatabase.__init__(self, "localhost", "", "", file_path, **options)
+
+    def connect(self):
+        return sqlite3.connect(self.__file_path, check_same_thread = False)
+
+
+def write_synthetic_database(file_path, number_of_patients = 3000, number_of_rows_per_year = 100000, years = None,
+                             number_of_drugs = 400, number_of_conditions = 300, seed = 0):
+
+    # input: <type: string> file_path of the sqlite3 database to be written
+    #        <type: int> number_of_rows_per_year: rows of each prescription and each diagnosis table
+    # output: <type: int> number of rows in the Ambutory tables
+    # Drug_No, ICD9 and ID cells are padded with blanks like the NHIRD tables, and some codes are left unmapped
+    if years is None:
+        years = [x for x in range(2004, 2009, 1)]
+    random_state = random.Random(seed)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+    database = sqlite3.connect(file_path)
+    try:
+        database.execute("CREATE TABLE Drug_Description (Drug_No TEXT, ATC_Code TEXT)")
+        database.execute("CREATE TABLE ATCCode_MedDRA (ATC_Code TEXT, MedDRA TEXT)")
+        database.execute("CREATE TABLE ICD9CM_UMLSCID (ICD9CM TEXT, UMLSCID TEXT)")
+        database.executemany("INSERT INTO Drug_Description VALUES (?, ?)",
+                             [("DN%05d " % i, "ATC%04d" % (i / 2)) for i in range(0, number_of_drugs, 1)])
+        database.executemany("INSERT INTO ATCCode_MedDRA VALUES (?, ?)",
+                             [("ATC%04d" % i, "M%04d" % i) for i in range(0, number_of_drugs / 2, 1) if i % 10 != 9])
+        acode_icd9s = []
+        for i in range(0, number_of_conditions, 1):
+            if i % 10 == 0:
+                acode_icd9 = "V%03d%d" % (i % 1000, i % 7) # V codes get the dot after 4 characters
+                icd9cm = acode_icd9[0:4] + "." + acode_icd9[4:]
+            else:
+                acode_icd9 = "%03d%02d" % (i % 1000, i % 50)
+                icd9cm = acode_icd9[0:3] + "." + acode_icd9[3:]
+            acode_icd9s.append(acode_icd9)
+            if i % 17 != 16:
+                database.execute("INSERT INTO ICD9CM_UMLSCID VALUES (?, ?)", (icd9cm, "C%07d" % i))
+        number_of_rows = 0
+        for year in years:
+            first_date = datetime.date(year, 1, 1)
+            prescription_table_name = "Ambutory_OO" + str(year) + "_R20_Full"
+            diagnosis_table_name = "Ambutory_CD" + str(year) + "_R20"
+            database.execute("CREATE TABLE " + prescription_table_name + " (ID TEXT, Func_Date TEXT, Drug_No TEXT)")
+            database.execute("CREATE TABLE " + diagnosis_table_name +
+                             " (ID TEXT, Func_Date TEXT, ACode_ICD9_1 TEXT, ACode_ICD9_2 TEXT, ACode_ICD9_3 TEXT)")
+            prescription_rows = []
+            diagnosis_rows = []
+            for i in range(0, number_of_rows_per_year, 1):
+                id = "P%07d " % random_state.randint(0, number_of_patients - 1)
+                func_date = str(first_date + datetime.timedelta(days = random_state.randint(0, 364)))
+                prescription_rows.append((id, func_date, "DN%05d " % random_state.randint(0, number_of_drugs - 1)))
+                acode_icd9s_of_row = [random_state.choice(acode_icd9s) + " " if random_state.random() < 0.6 else "" for j in range(0, 3, 1)]
+                diagnosis_rows.append(tuple([id, func_date] + acode_icd9s_of_row))
+            database.executemany("INSERT INTO " + prescription_table_name + " VALUES (?, ?, ?)", prescription_rows)
+            database.executemany("INSERT INTO " + diagnosis_table_name + " VALUES (?, ?, ?, ?, ?)", diagnosis_rows)
+            number_of_rows += len(prescription_rows) + len(diagnosis_rows)
+        database.commit()
+    finally:
+        database.close()
+    return number_of_rows
+
+
+def benchmark_loader(file_path, number_of_rows, number_of_runs = 3, **options):
+
+    # input: <type: string> file_path of a database written by write_synthetic_database
+    #        options: passed to LongitudeObservationalDatabase, e.g. batch_size, number_of_connections
+    # output: <type: float> best wall time in seconds of loading all the Ambutory tables
+    best_seconds = None
+    for run in range(0, number_of_runs, 1):
+        start_time = time.time()
+        observational_database = SyntheticObservationalDatabase(file_path, **options)
+        seconds = time.time() - start_time
+        if (best_seconds is None) or (seconds < best_seconds):
+            best_seconds = seconds
+    id_medical_records_hash_map = observational_database.get_id_medical_records_hash_map()
+    number_of_visits = sum([len(x) for x in id_medical_records_hash_map.values()])
+    print "%s: %.2fs, %d rows/s, %d patients, %d visits, %.0f bytes/visit" % (
+        options, best_seconds, number_of_rows / best_seconds, len(id_medical_records_hash_map), number_of_visits,
+        measure_bytes_per_visit(id_medical_records_hash_map))
+    return best_seconds
+
+
+def get_deep_size(objects):
+
+    # input: <type: list> objects
+    # output: <type: int> sys.getsizeof of the objects and of everything they reach through containers, instance dicts
+    #         and __slots__, each object counted once however many objects share it (e.g. interned ids, dates and codes)
+    seen_ids = set()
+    deep_size = 0
+    stack = list(objects)
+    while len(stack) > 0:
+        x = stack.pop()
+        if id(x) in seen_ids:
+            continue
+        seen_ids.add(id(x))
+        deep_size += sys.getsizeof(x)
+        if isinstance(x, dict):
+            stack.extend(x.keys())
+            stack.extend(x.values())
+        elif isinstance(x, (list, tuple, set, frozenset)):
+            stack.extend(x)
+        elif not isinstance(x, (basestring, int, long, float, datetime.date)):
+            if hasattr(x, "__dict__"):
+                stack.append(x.__dict__)
+            for cls in type(x).__mro__:
+                for slot in getattr(cls, "__slots__", ()):
+                    if slot.startswith("__") and not slot.endswith("__"):
+                        slot = "_" + cls.__name__.lstrip("_") + slot # name mangling
+                    if hasattr(x, slot):
+                        stack.append(getattr(x, slot))
+    return deep_size
+
+
+def measure_bytes_per_visit(id_medical_records_hash_map):
+
+    # output: <type: float> deep size of the medical records (get_deep_size) per visit, the memory figure of MedicalRecord
+    medical_records = [x for y in id_medical_records_hash_map.itervalues() for x in y]
+    if len(medical_records) == 0:
+        return 0.0
+    return get_deep_size(medical_records) / float(len(medical_records))
+
+
+def build_visit_hash_map(id_medical_records_hash_map):
+
+    # output: <type: dict> key: (id, func_date), value: (prescription_records, diagnosis_records) sorted,
+    #         so that loads whose medical records differ only in order compare equal
+    visit_hash_map = {}
+    for id, medical_records in id_medical_records_hash_map.items():
+        for medical_record in medical_records:
+            visit_hash_map[(id, medical_record.get_func_date())] = (tuple(sorted(medical_record.get_prescription_records())), 
+                                                                    tuple(sorted(medical_record.get_diagnosis_records())))
+    return visit_hash_map
+
+
+def check_loader(file_path, directory_path):
+
+    # input: <type: string> file_path of a database written by write_synthetic_database
+    #        <type: string> directory_path: scratch directory for a copy of the database and the snapshots
+    # sqlite stands in for MySQL: unbatched, batched and multi-connection loads must give the same medical records,
+    # and a missing Ambutory table must raise in each of them without writing a snapshot; raises ValueError otherwise
+    option_list = [{}, {"batch_size": 1000}, {"number_of_connections": 4}, {"batch_size": 1000, "number_of_connections": 4}]
+    expected_visit_hash_map = None
+    for options in option_list:
+        visit_hash_map = build_visit_hash_map(SyntheticObservationalDatabase(file_path, **options).get_id_medical_records_hash_map())
+        if expected_visit_hash_map is None:
+            expected_visit_hash_map = visit_hash_map
+        elif visit_hash_map != expected_visit_hash_map:
+            raise ValueError("%s loads other medical records than %s" % (options, option_list[0]))
+    print "%d visits loaded alike with %s" % (len(expected_visit_hash_map), option_list)
+
+    missing_table_file_path = os.path.join(directory_path, "missing_table.db")
+    shutil.copyfile(file_path, missing_table_file_path)
+    database = sqlite3.connect(missing_table_file_path)
+    try:
+        database.execute("DROP TABLE Ambutory_CD2006_R20")
+        database.commit()
+    finally:
+        database.close()
+    for options in option_list:
+        snapshot_path = os.path.join(directory_path, "snapshot")
+        try:
+            SyntheticObservationalDatabase(missing_table_file_path, snapshot_path = snapshot_path, **options)
+        except sqlite3.OperationalError:
+            pass
+        else:
+            raise ValueError("%s loads a database without Ambutory_CD2006_R20" % (options))
+        if os.path.isdir(snapshot_path) and (len(os.listdir(snapshot_path)) > 0):
+            raise ValueError("%s writes a snapshot of a database without Ambutory_CD2006_R20" % (options))
+    print "a missing table raises with %s" % (option_list)
+
+
+def build_zipf_probabilities(number_of_codes, skew):
+
+    # input: <type: int> number_of_codes
+    #        <type: float> skew: Zipf exponent, the code of rank r is drawn with probability proportional to 1 / r ** skew
+    #        (0: uniform; around 1: a few codes dominate, like the most prescribed drugs)
+    # output: <type: numpy.ndarray> probability of each code
+    weights = 1.0 / np.arange(1, number_of_codes + 1, dtype = np.float64) ** skew
+    return weights / weights.sum()
+
+
+def generate_synthetic_cohort(number_of_patients = 10000, number_of_visits_per_patient = 20, number_of_drugs = 1000, 
+                              number_of_conditions = 2000, skew = 1.0, number_of_drugs_per_visit = 2, 
+                              number_of_conditions_per_visit = 2, number_of_days = 1826, seed = 0):
+
+    # output: <type: dict> id_medical_records_hash_map, key: <type: string> id, value: <type: MedicalRecord list>
+    # the numbers of visits per patient and of codes per visit are uniform around their means,
+    # visits fall on distinct days within number_of_days of 2004-01-01, codes are drawn with build_zipf_probabilities
+    random_state = np.random.RandomState(seed)
+    numbers_of_visits = random_state.randint(1, 2 * number_of_visits_per_patient, size = number_of_patients)
+    number_of_visits = int(numbers_of_visits.sum())
+    numbers_of_drugs = random_state.randint(0, 2 * number_of_drugs_per_visit + 1, size = number_of_visits)
+    numbers_of_conditions = random_state.randint(0, 2 * number_of_conditions_per_visit + 1, size = number_of_visits)
+    drug_ids = random_state.choice(number_of_drugs, size = int(numbers_of_drugs.sum()), 
+                                   p = build_zipf_probabilities(number_of_drugs, skew)).tolist()
+    condition_ids = random_state.choice(number_of_conditions, size = int(numbers_of_conditions.sum()), 
+                                        p = build_zipf_probabilities(number_of_conditions, skew)).tolist()
+    drugs = ["M%05d" % x for x in range(0, number_of_drugs, 1)]
+    conditions = ["C%07d" % x for x in range(0, number_of_conditions, 1)]
+    first_date = datetime.date(2004, 1, 1)
+    func_dates = [first_date + datetime.timedelta(days = x) for x in range(0, number_of_days, 1)]
+
+    id_medical_records_hash_map = {}
+    visit = 0
+    drug_offset = 0
+    condition_offset = 0
+    for patient in range(0, number_of_patients, 1):
+        id = "P%07d" % patient
+        medical_records = []
+        for day in sorted(random_state.choice(number_of_days, size = min(int(numbers_of_visits[patient]), number_of_days), replace = False).tolist()):
+            next_drug_offset = drug_offset + numbers_of_drugs[visit]
+            next_condition_offset = condition_offset + numbers_of_conditions[visit]
+            medical_records.append(MedicalRecord(id, func_dates[day], 
+                                                 [drugs[x] for x in drug_ids[drug_offset:next_drug_offset]], 
+                                                 [conditions[x] for x in condition_ids[condition_offset:next_condition_offset]]))
+            visit += 1
+            drug_offset = next_drug_offset
+            condition_offset = next_condition_offset
+        id_medical_records_hash_map[id] = medical_records
+    return id_medical_records_hash_map
+
+
+def write_synthetic_cohort(file_path, **options):
+
+    # input: <type: string> file_path of the medical records file to be written
+    #        options: passed to generate_synthetic_cohort
+    # run in a separate process (see generate_synthetic_cohort_file), so that the cohort is not in the peak memory of the benchmark
+    write_id_medical_records_hash_map(file_path, generate_synthetic_cohort(**options))
+
+
+def generate_synthetic_cohort_file(file_path, **options):
+
+    # write_synthetic_cohort in a child process; ru_maxrss never decreases, so a cohort generated in this process
+    # would stay in the peak memory of every stage timed afterwards
+    pool = multiprocessing.Pool(processes = 1)
+    try:
+        pool.apply(write_synthetic_cohort, (file_path,), options)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def get_peak_memory():
+
+    # output: <type: int> peak resident set size of this process in bytes so far (ru_maxrss is in KB on Linux, bytes on OS X)
+    peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak_memory *= 1024
+    return peak_memory
+
+
+def run_stage(stages, name, function, unit, count_items):
+
+    # input: <type: list> stages, extended with the report of this stage
+    #        <type: function> function: the stage, called without arguments
+    #        <type: string> unit: what count_items(result of function) counts, e.g. "visits"
+    # output: result of function
+    # peak_memory_bytes is the peak of the whole process so far, peak_memory_increase_bytes how much this stage raised it
+    start_peak_memory = get_peak_memory()
+    start_time = time.time()
+    start_times = os.times()
+    result = function()
+    end_times = os.times()
+    wall_seconds = time.time() - start_time
+    peak_memory = get_peak_memory()
+    number_of_items = count_items(result)
+    stages.append({
+        "stage": name,
+        "wall_seconds": wall_seconds,
+        "cpu_seconds": (end_times[0] - start_times[0]) + (end_times[1] - start_times[1]),
+        "items": number_of_items,
+        "unit": unit,
+        "items_per_second": number_of_items / wall_seconds if wall_seconds > 0 else None,
+        "peak_memory_bytes": peak_memory,
+        "peak_memory_increase_bytes": peak_memory - start_peak_memory,
+    })
+    return result
+
+
+def benchmark_pipeline(medical_records_file_path, directory_path, number_of_processes = 1, leverage_table_format = "dense", metrics = None):
+
+    # input: <type: string> medical_records_file_path, e.g. written by generate_synthetic_cohort_file
+    #        <type: string> directory_path: scratch directory for the output tables
+    #        <type: Metrics> metrics: passed to UnexpectedDrugConditionSignal; None: not instrumented
+    # output: <type: dict list> one report per stage, in pipeline order
+    # ingest reads the cohort from the medical records file, so no database is needed
+    stages = []
+    id_medical_records_hash_map = run_stage(stages, "ingest", lambda: read_id_medical_records_hash_map(medical_records_file_path), 
+                                            "visits", lambda x: sum([len(y) for y in x.itervalues()]))
+    udcs = UnexpectedDrugConditionSignal(metrics = metrics)
+    run_stage(stages, "build_patient_histories", lambda: udcs.build_patient_histories(id_medical_records_hash_map), 
+              "patients", lambda x: udcs.number_of_patient_histories())
+    run_stage(stages, "build_count_hash_maps", lambda: udcs.build_count_hash_maps(number_of_processes = number_of_processes), 
+              "drug_condition_pairs", lambda x: udcs.get_number_of_drug_condition_pair())
+    run_stage(stages, "build_leverage_hash_map", udcs.build_leverage_hash_map, 
+              "distinct_drug_condition_pairs", lambda x: udcs.get_drug_condition_pair_count_matrix().nnz)
+
+    def write_output():
+        file_paths = [os.path.join(directory_path, x) for x in ["drug_condition_pair_count_table.csv", "drug_count_table.csv", 
+                                                                "condition_count_table.csv", "drug_condition_pair_leverage_table.csv", 
+                                                                "leverage_table.csv"]]
+        write_drug_condition_pair_table_to_file(file_paths[0], udcs)
+        write_hash_map_to_file(file_paths[1], udcs.get_drug_count_hash_map())
+        write_hash_map_to_file(file_paths[2], udcs.get_condition_count_hash_map())
+        write_drug_condition_pair_table_to_file(file_paths[3], udcs, measure = "leverage")
+        write_leverage_table_to_file(file_paths[4], udcs, file_format = leverage_table_format)
+        return file_paths
+
+    run_stage(stages, "write_output", write_output, "bytes", lambda x: sum([os.path.getsize(y) for y in x]))
+    return stages
+
+
+
+if __name__ == "__main__":
+
+    # usage: python Benchmark.py [pipeline] [--number_of_patients N ...] [--output report.json]
+    #        python Benchmark.py pipeline --metrics_report metrics.json --profile pipeline.prof
+    #        python Benchmark.py loader [--number_of_rows_per_year N] [--number_of_patients N]
+    #        python Benchmark.py check_loader [--number_of_rows_per_year N] [--number_of_patients N]
+    parser = argparse.ArgumentParser(description = "time the UTARs pipeline on synthetic data")
+    parser.add_argument("mode", nargs = "?", default = "pipeline", choices = ["pipeline", "loader", "check_loader"])
+    parser.add_argument("--number_of_patients", type = int, default = 10000)
+    parser.add_argument("--number_of_visits_per_patient", type = int, default = 20)
+    parser.add_argument("--number_of_drugs", type = int, default = 1000)
+    parser.add_argument("--number_of_conditions", type = int, default = 2000)
+    parser.add_argument("--skew", type = float, default = 1.0)
+    parser.add_argument("--number_of_drugs_per_visit", type = int, default = 2)
+    parser.add_argument("--number_of_conditions_per_visit", type = int, default = 2)
+    parser.add_argument("--number_of_processes", type = int, default = 1)
+    parser.add_argument("--leverage_table_format", default = "dense", choices = ["dense", "triplet", "npz", "columnar"])
+    parser.add_argument("--number_of_rows_per_year", type = int, default = 100000)
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--output", default = None, help = "JSON report file; standard output if not given")
+    parser.add_argument("--metrics_report", default = None, help = "JSON file of the Metrics of the pipeline stages")
+    parser.add_argument("--profile", default = None, help = "cProfile dump of the pipeline stages")
+    arguments = parser.parse_args()
+
+    directory_path = tempfile.mkdtemp()
+    try:
+        if arguments.mode in ("loader", "check_loader"):
+            file_path = os.path.join(directory_path, "ambutory.db")
+            number_of_rows = write_synthetic_database(file_path, arguments.number_of_patients, arguments.number_of_rows_per_year, seed = arguments.seed)
+            print "%d synthetic rows of %d patients" % (number_of_rows, arguments.number_of_patients)
+            if arguments.mode == "check_loader":
+                check_loader(file_path, directory_path)
+            else:
+                benchmark_loader(file_path, number_of_rows)
+                benchmark_loader(file_path, number_of_rows, batch_size = 10000)
+        else:
+            configuration = dict([(x, getattr(arguments, x)) for x in ["number_of_patients", "number_of_visits_per_patient", 
+                                                                        "number_of_drugs", "number_of_conditions", "skew", 
+                                                                        "number_of_drugs_per_visit", "number_of_conditions_per_visit", "seed"]])
+            medical_records_file_path = os.path.join(directory_path, "medical_records.csv")
+            generate_synthetic_cohort_file(medical_records_file_path, **configuration)
+            configuration["number_of_processes"] = arguments.number_of_processes
+            configuration["leverage_table_format"] = arguments.leverage_table_format
+            metrics = None
+            if (arguments.metrics_report is not None) or (arguments.profile is not None):
+                metrics = Metrics(profile = arguments.profile is not None)
+            stages = benchmark_pipeline(medical_records_file_path, directory_path, arguments.number_of_processes, arguments.leverage_table_format, metrics)
+            if arguments.metrics_report is not None:
+                metrics.write_report(arguments.metrics_report)
+            if arguments.profile is not None:
+                metrics.write_profile(arguments.profile)
+            report = {
+                "configuration": configuration,
+                "python_version": platform.python_version(),
+                "stages": stages,
+                "total_wall_seconds": sum([x["wall_seconds"] for x in stages]),
+                "peak_memory_bytes": get_peak_memory(),
+            }
+            if arguments.output is None:
+                print json.dumps(report, indent = 2, sort_keys = True)
+            else:
+                with open(arguments.output, "w") as file:
+                    json.dump(report, file, indent = 2, sort_keys = True)
+    finally:
+        shutil.rmtree(directory_path)
@@ -5,18 +5,48 @@ module name: DrugConditionSignal
 '''
 
 import sys
+import time
+import bisect
 import datetime
+import cPickle
+import functools
+import heapq
+import multiprocessing
+import numpy as np
+import scipy.sparse as sparse
 import IO as file_handler
 from ObservationalData import LongitudeObservationalDatabase
 from ObservationalData import MedicalRecord
+from ObservationalData import read_id_medical_records_hash_map
+from ObservationalData import iterate_id_medical_records
+from Vocabulary import Vocabulary
+from Vocabulary import pack_pair
+from Vocabulary import unpack_pair
+from Vocabulary import CONDITION_ID_BITS
+from Vocabulary import CONDITION_ID_MASK
+from Sketch import ApproximateDrugConditionPairCounter
+from ExternalSort import ExternalDrugConditionPairCounter
+from Metrics import Metrics
+from Metrics import measure_stage
 from operator import methodcaller
 
-class PatientHistory:
+# days before and after a prescription searched for conditions
+DAY_DELTA = 30
+
+class PatientHistory(object):
     
+    __slots__ = ("__id", "__medical_records", "__diagnosis_date_index")
+
     def __init__(self, id, medical_records):
 
         self.__id = id
         self.__medical_records = sorted(medical_records, key=methodcaller('get_func_date'))
+
+        # key: <type: string> diagnosis_record
+        # value: <type: datetime list> sorted func_dates of the medical records having the diagnosis_record
+        self.__diagnosis_date_index = {}
+        for medical_record in self.__medical_records:
+            self.index_diagnosis_records(medical_record)
     
     def get_id(self):
         return self.__id
@@ -26,6 +56,36 @@ class PatientHistory:
     
     def add_medical_record(self, medical_record):
         self.__medical_records.append(medical_record)
+        self.index_diagnosis_records(medical_record)
+
+    def index_diagnosis_records(self, medical_record):
+        func_date = medical_record.get_func_date()
+        for diagnosis_record in medical_record.get_diagnosis_records():
+            func_dates = self.__diagnosis_date_index.get(diagnosis_record, None)
+            if func_dates is None:
+                self.__diagnosis_date_index[diagnosis_record] = [func_date]
+            elif func_dates[-1] <= func_date:
+                func_dates.append(func_date)
+            else:
+                bisect.insort_right(func_dates, func_date)
+
+    def get_diagnosis_dates(self, diagnosis_record):
+        return self.__diagnosis_date_index.get(diagnosis_record, [])
+
+    def get_first_onset_date(self, diagnosis_record):
+        func_dates = self.__diagnosis_date_index.get(diagnosis_record, None)
+        if func_dates is None:
+            return None
+        return func_dates[0]
+
+    def has_diagnosis_record_between(self, diagnosis_record, start_date, end_date):
+
+        # output: <type: bool> whether diagnosis_record occurs with start_date < func_date < end_date
+        func_dates = self.__diagnosis_date_index.get(diagnosis_record, None)
+        if func_dates is None:
+            return False
+        i = bisect.bisect_right(func_dates, start_date)
+        return (i < len(func_dates)) and (func_dates[i] < end_date)
     
     def extract_func_dates(self):
         func_dates = []
@@ -70,24 +130,72 @@ class PatientHistory:
         diagnosis_records = sorted(list(set(diagnosis_records)))
         return diagnosis_records
 
-    def detect_drug_condition_pairs(self):
-        func_dates = self.extract_func_dates()
-        drug_condition_pairs = []
+    def detect_drug_condition_groups(self, start_date = None, drugs = None, conditions = None):
+
+        # input: <type: datetime> start_date: only prescriptions after start_date are reported if given
+        #        <type: frozenset> drugs, conditions: if given, only these drugs and conditions are reported
+        # output: <type: generator> one (prescription_records, diagnosis_records) tuple per prescribing medical record,
+        #         where diagnosis_records are the sorted new conditions diagnosed within 30 days after the prescription
+        # sweep the date-sorted medical records once with a forward-only after window;
+        # a condition is new if the diagnosis date index has no occurrence in the before window
+        # with drugs and conditions, visits without any of the drugs are skipped before the window slides,
+        # and the window only holds (and the index is only searched for) the conditions
+        after_window = DiagnosisWindow(self.__medical_records, conditions)
+        day_delta = datetime.timedelta(days = DAY_DELTA)
         for medical_record in self.__medical_records:
             prescription_records = medical_record.get_prescription_records()
+            if drugs is not None:
+                prescription_records = [x for x in prescription_records if x in drugs]
             if len(prescription_records) == 0:
                 continue
             func_date = medical_record.get_func_date()
-            diagnosis_records_before = self.extract_diagnosis_records_before_a_date(func_date, 30)
-            diagnosis_records_after = self.extract_diagnosis_records_after_a_date(func_date, 30)
+            if (start_date is not None) and (func_date <= start_date):
+                continue
+            after_window.slide(func_date, func_date + day_delta)
+            before_date = func_date - day_delta
             diagnosis_records = []
-            for diagnosis_record in diagnosis_records_after:
-                if not(diagnosis_record in diagnosis_records_before):
+            for diagnosis_record in sorted(after_window.get_diagnosis_records()):
+                if not self.has_diagnosis_record_between(diagnosis_record, before_date, func_date):
                     diagnosis_records.append(diagnosis_record)
             if len(diagnosis_records) == 0:
                 continue
             #print "%s; %s; %s" % (func_date.strftime('%Y-%m-%d'), ",".join(prescription_records), ",".join(diagnosis_records))
+            yield prescription_records, diagnosis_records
+
+    def detect_drug_condition_groups_for_windows(self, windows):
+
+        # input: <type: (int, int) list> windows: (before_day_delta, after_day_delta) pairs
+        # output: <type: generator> one (prescription_records, diagnosis_records_list) tuple per prescribing medical record,
+        #         diagnosis_records_list holding the sorted new conditions of each window, in the order of windows
+        # one sweep serves all windows: the after window of the longest after_day_delta is slid once,
+        # and each window checks its own bounds against the diagnosis date index
+        after_window = DiagnosisWindow(self.__medical_records)
+        max_after_day_delta = datetime.timedelta(days = max([x[1] for x in windows]))
+        day_deltas = [(datetime.timedelta(days = x[0]), datetime.timedelta(days = x[1])) for x in windows]
+        for medical_record in self.__medical_records:
+            prescription_records = medical_record.get_prescription_records()
+            if len(prescription_records) == 0:
+                continue
+            func_date = medical_record.get_func_date()
+            after_window.slide(func_date, func_date + max_after_day_delta)
+            diagnosis_records_after = sorted(after_window.get_diagnosis_records())
+            if len(diagnosis_records_after) == 0:
+                continue
+            diagnosis_records_list = []
+            for before_day_delta, after_day_delta in day_deltas:
+                before_date = func_date - before_day_delta
+                after_date = func_date + after_day_delta
+                diagnosis_records = []
+                for diagnosis_record in diagnosis_records_after:
+                    if self.has_diagnosis_record_between(diagnosis_record, func_date, after_date) and \
+                       not self.has_diagnosis_record_between(diagnosis_record, before_date, func_date):
+                        diagnosis_records.append(diagnosis_record)
+                diagnosis_records_list.append(diagnosis_records)
+            yield prescription_records, diagnosis_records_list
 
+    def detect_drug_condition_pairs(self):
+        drug_condition_pairs = []
+        for prescription_records, diagnosis_records in self.detect_drug_condition_groups():
             # combine prescription_records and diagnosis_records
             for prescription_record in prescription_records:
                 for diagnosis_record in diagnosis_records:
@@ -96,33 +204,206 @@ class PatientHistory:
         return drug_condition_pairs
 
 
+class DiagnosisWindow:
+
+    def __init__(self, medical_records, diagnosis_records = None):
+
+        # medical_records must be sorted by func_date
+        # diagnosis_records: <type: frozenset> if given, only these diagnosis_records are held
+
+        # func_dates and diagnosis_records of the medical records having any diagnosis_record held,
+        # so that the window does not step over the other medical records
+        self.__func_dates = []
+        self.__diagnosis_records_list = []
+        for medical_record in medical_records:
+            medical_record_diagnosis_records = medical_record.get_diagnosis_records()
+            if diagnosis_records is not None:
+                medical_record_diagnosis_records = [x for x in medical_record_diagnosis_records if x in diagnosis_records]
+            if len(medical_record_diagnosis_records) > 0:
+                self.__func_dates.append(medical_record.get_func_date())
+                self.__diagnosis_records_list.append(medical_record_diagnosis_records)
+        self.__start = 0
+        self.__end = 0
+
+        # key: <type: string> diagnosis_record
+        # value: <type: int> number of medical records in the window having the diagnosis_record
+        self.__diagnosis_record_count_hash_map = {}
+
+    def get_diagnosis_records(self):
+        return self.__diagnosis_record_count_hash_map.keys()
+
+    def slide(self, start_date, end_date):
+
+        # keep the medical records with start_date < func_date < end_date in the window
+        # start_date and end_date must not decrease between calls
+        while (self.__end < len(self.__func_dates)) and (self.__func_dates[self.__end] < end_date):
+            self.add_diagnosis_records(self.__diagnosis_records_list[self.__end])
+            self.__end += 1
+        while (self.__start < self.__end) and (self.__func_dates[self.__start] <= start_date):
+            self.remove_diagnosis_records(self.__diagnosis_records_list[self.__start])
+            self.__start += 1
+
+    def add_diagnosis_records(self, diagnosis_records):
+        for diagnosis_record in diagnosis_records:
+            count = self.__diagnosis_record_count_hash_map.get(diagnosis_record, 0)
+            count += 1
+            self.__diagnosis_record_count_hash_map[diagnosis_record] = count
+
+    def remove_diagnosis_records(self, diagnosis_records):
+        for diagnosis_record in diagnosis_records:
+            count = self.__diagnosis_record_count_hash_map[diagnosis_record]
+            count -= 1
+            if count == 0:
+                del self.__diagnosis_record_count_hash_map[diagnosis_record]
+            else:
+                self.__diagnosis_record_count_hash_map[diagnosis_record] = count
+
+
 class UnexpectedDrugConditionSignal:
     
-    def __init__(self):
+    def __init__(self, metrics = None):
         self.__patient_histories = []
         self.__number_of_drug_condition_pair = 0
+
+        # <type: Metrics> stage times, per-patient visits, pairs and times, and hash map sizes are recorded into it; None: not instrumented
+        self.__metrics = metrics
+
+        # drugs (MedDRA) and conditions (UMLS) are counted by dense int ids
+        self.__drug_vocabulary = Vocabulary()
+        self.__condition_vocabulary = Vocabulary()
+
+        # key: <type: int> pack_pair(drug_id, condition_id)
+        # value: <type: int> count
         self.__drug_condition_pair_count_hash_map = {}
+
+        # out-of-core mode: the pair counts are (drug_condition_pair_ids, counts) memory-mapped arrays
+        # merged by build_count_hash_maps_out_of_core, instead of self.__drug_condition_pair_count_hash_map
+        self.__drug_condition_pair_count_arrays = None
+
+        # how the counts were made: "exact", "pruned" (min_drug_count or min_condition_count), "approximate" or "out_of_core";
+        # a count mode other than "exact" sticks, since later counts are added to the earlier ones
+        self.__count_mode = "exact"
+
+        # key: <type: int> drug_id
+        # value: <type: int> count
         self.__drug_count_hash_map = {}
+
+        # key: <type: int> condition_id
+        # value: <type: int> count
         self.__condition_count_hash_map = {}
-        self.__drug_condition_pair_leverage_hash_map = {}
+
+        # sparse drug_id x condition_id count matrix and its marginal vectors, built by build_count_matrix
+        self.__drug_condition_pair_count_matrix = None
+        self.__drug_count_vector = None
+        self.__condition_count_vector = None
+
+        # key: <type: string> measure name (see MEASURES)
+        # value: <type: scipy.sparse.csr_matrix> measure of every counted drug_condition_pair
+        self.__drug_condition_pair_measure_matrix_hash_map = {}
+
+        # incremental mode: medical records of each patient that later visits can still pair with
+        # key: <type: string> id
+        # value: <type: MedicalRecord list> medical records within 2 * DAY_DELTA days of the patient's last visit
+        self.__id_trailing_medical_records_hash_map = {}
+
+    # the getters below return views keyed by code strings (drug + "," + condition for pairs), built on each call
 
     def get_drug_condition_pair_count_hash_map(self):
-        return self.__drug_condition_pair_count_hash_map
+        return self.build_drug_condition_pair_hash_map(self.iterate_drug_condition_pair_counts())
 
     def get_drug_count_hash_map(self):
-        return self.__drug_count_hash_map
+        return self.build_code_hash_map(self.__drug_vocabulary, self.__drug_count_hash_map)
 
     def get_condition_count_hash_map(self):
-        return self.__condition_count_hash_map
+        return self.build_code_hash_map(self.__condition_vocabulary, self.__condition_count_hash_map)
 
     def get_drug_condition_pair_leverage_hash_map(self):
-        return self.__drug_condition_pair_leverage_hash_map
+        return self.get_drug_condition_pair_measure_hash_map("leverage")
+
+    def get_drug_condition_pair_measure_hash_map(self, measure):
+        return self.build_drug_condition_pair_hash_map(self.iterate_drug_condition_pair_measures(measure))
+
+    def get_drug_condition_pair_count_matrix(self):
+        return self.__drug_condition_pair_count_matrix
+
+    def get_drug_condition_pair_measure_matrix(self, measure):
+        return self.__drug_condition_pair_measure_matrix_hash_map.get(measure, None)
+
+    def get_drug_vocabulary(self):
+        return self.__drug_vocabulary
+
+    def get_condition_vocabulary(self):
+        return self.__condition_vocabulary
+
+    def get_metrics(self):
+        return self.__metrics
+
+    def get_count_mode(self):
+        return self.__count_mode
+
+    def set_count_mode(self, count_mode):
+        if self.__count_mode == "exact":
+            self.__count_mode = count_mode
+
+    def check_exact_counts(self):
+
+        # update_count_hash_maps recounts the trailing windows against every pair, drug and condition count,
+        # so the counts must be exact, unpruned and in memory
+        if self.__count_mode != "exact":
+            raise ValueError("incremental counting needs exact counts, not %s ones" % (self.__count_mode))
+
+    def check_in_memory_counts(self):
+
+        # in-memory counting adds to the count hash maps, which out-of-core counts are not in;
+        # the getters and build_count_matrix would otherwise keep reading the merged arrays
+        if self.__drug_condition_pair_count_arrays is not None:
+            raise ValueError("the counts are out of core; count in memory with a new UnexpectedDrugConditionSignal")
+
+    def get_number_of_drug_condition_pair(self):
+        return self.__number_of_drug_condition_pair
+
+    def iterate_drug_condition_pair_counts(self):
+
+        # output: <type: iterator> (drug_condition_pair_id, count) of the in-memory or, in out-of-core mode, the merged counts
+        if self.__drug_condition_pair_count_arrays is None:
+            return self.__drug_condition_pair_count_hash_map.iteritems()
+        drug_condition_pair_ids, counts = self.__drug_condition_pair_count_arrays
+        return iterate_arrays_in_chunks(drug_condition_pair_ids, counts)
+
+    def iterate_drug_condition_pair_measures(self, measure):
+
+        # output: <type: iterator> (drug_condition_pair_id, value) of the measure matrix, empty if measure was not built
+        matrix = self.__drug_condition_pair_measure_matrix_hash_map.get(measure, None)
+        if matrix is None:
+            return iter([])
+        matrix = matrix.tocoo()
+        return iterate_arrays_in_chunks((matrix.row.astype(np.int64) << CONDITION_ID_BITS) | matrix.col, matrix.data)
+
+    def iterate_drug_condition_pairs(self, drug_condition_pair_values):
+
+        # input: <type: iterable> (drug_condition_pair_id, value)
+        # output: <type: generator> (drug + "," + condition, value)
+        drugs = self.__drug_vocabulary.get_codes()
+        conditions = self.__condition_vocabulary.get_codes()
+        for drug_condition_pair_id, value in drug_condition_pair_values:
+            drug_id, condition_id = unpack_pair(drug_condition_pair_id)
+            yield drugs[drug_id] + "," + conditions[condition_id], value
+
+    def build_code_hash_map(self, vocabulary, id_hash_map):
+        codes = vocabulary.get_codes()
+        return dict((codes[code_id], value) for code_id, value in id_hash_map.iteritems())
+
+    def build_drug_condition_pair_hash_map(self, drug_condition_pair_values):
+        return dict(self.iterate_drug_condition_pairs(drug_condition_pair_values))
 
     def build_patient_histories(self, id_medical_records_hash_map):
-        del self.__patient_histories[:] # delete elements in self.__patient_histories
-        for id, medical_records in id_medical_records_hash_map.items():
-            patient_history = PatientHistory(id, medical_records)
-            self.__patient_histories.append(patient_history)
+        with measure_stage(self.__metrics, "build_patient_histories"):
+            del self.__patient_histories[:] # delete elements in self.__patient_histories
+            for id, medical_records in id_medical_records_hash_map.items():
+                patient_history = PatientHistory(id, medical_records)
+                self.__patient_histories.append(patient_history)
+        if self.__metrics is not None:
+            self.__metrics.set_size("patient_histories", len(self.__patient_histories))
 
     def append_patient_history(self, patient_history):
         self.__patient_histories.append(patient_history)
@@ -135,37 +416,488 @@ class UnexpectedDrugConditionSignal:
     def number_of_patient_histories(self):
         return len(self.__patient_histories)
 
-    def build_count_hash_maps(self):        
-        for patient_history in self.__patient_histories:            
-            drug_condition_pairs = patient_history.detect_drug_condition_pairs()
-            for drug_condition_pair in drug_condition_pairs:
-                self.__number_of_drug_condition_pair += 1
-                drug = drug_condition_pair.split(",")[0]
-                condition = drug_condition_pair.split(",")[1]
-                # update self.__drug_condition_pair_count_hash_map
-                count = self.__drug_condition_pair_count_hash_map.get(drug_condition_pair, 0)
-                count += 1
-                self.__drug_condition_pair_count_hash_map[drug_condition_pair] = count
-                # update self.__drug_count_hash_map
-                count = self.__drug_count_hash_map.get(drug, 0)
-                count += 1
-                self.__drug_count_hash_map[drug] = count
-                # update self.__condition_count_hash_map
-                count = self.__condition_count_hash_map.get(condition, 0)
-                count += 1
-                self.__condition_count_hash_map[condition] = count
-
-    def build_leverage_hash_map(self):
+    def build_count_hash_maps(self, number_of_processes = 1, shard_size = None, min_drug_count = 1, min_condition_count = 1):
+
+        # number_of_processes > 1 shards self.__patient_histories across a process pool
+        # shard_size: number of patient histories sent to a worker at a time
+        # min_drug_count, min_condition_count > 1: a first pass counts only the drug and condition marginals,
+        # a second pass counts only the pairs of drugs and conditions with at least those counts;
+        # marginals and the total stay exact, so a surviving pair has the same leverage as without pruning
+        self.check_in_memory_counts()
+        with measure_stage(self.__metrics, "build_count_hash_maps"):
+            if (min_drug_count <= 1) and (min_condition_count <= 1):
+                self.count_patient_histories(number_of_processes, shard_size)
+            else:
+                self.count_patient_histories(number_of_processes, shard_size, count_drug_condition_pairs = False)
+                drugs = frozenset([drug for drug, count in self.get_drug_count_hash_map().iteritems() if count >= min_drug_count])
+                conditions = frozenset([condition for condition, count in self.get_condition_count_hash_map().iteritems() if count >= min_condition_count])
+                self.count_patient_histories(number_of_processes, shard_size, count_marginals = False, drugs = drugs, conditions = conditions)
+                self.set_count_mode("pruned")
+        self.record_count_sizes()
+
+    def record_count_sizes(self):
+        if self.__metrics is None:
+            return
+        self.__metrics.set_size("drug_condition_pair_count_hash_map", len(self.__drug_condition_pair_count_hash_map))
+        self.__metrics.set_size("drug_count_hash_map", len(self.__drug_count_hash_map))
+        self.__metrics.set_size("condition_count_hash_map", len(self.__condition_count_hash_map))
+        self.__metrics.set_size("drug_vocabulary", len(self.__drug_vocabulary))
+        self.__metrics.set_size("condition_vocabulary", len(self.__condition_vocabulary))
+
+    def count_patient_histories(self, number_of_processes, shard_size, **options):
+
+        # options: keyword arguments of count_drug_condition_pairs
+        # the patients are recorded into self.__metrics by the pass that counts the marginals
+        metrics = None
+        if options.get("count_marginals", True):
+            metrics = self.__metrics
+        if number_of_processes <= 1:
+            counts = count_drug_condition_pairs(self.__patient_histories, self.__drug_vocabulary, self.__condition_vocabulary, metrics = metrics, **options)
+            self.merge_count_hash_maps(*counts)
+            return
+
+        if shard_size is None:
+            shard_size = max(1, len(self.__patient_histories) // (number_of_processes * 4))
+        shards = (self.__patient_histories[i:i + shard_size] for i in range(0, len(self.__patient_histories), shard_size))
+        pool = multiprocessing.Pool(processes = number_of_processes)
+        try:
+            # imap keeps the shard order, so the merge is deterministic
+            if metrics is None:
+                for counts in pool.imap(functools.partial(count_drug_condition_pairs, **options), shards):
+                    self.merge_count_hash_maps(*counts)
+            else:
+                shard_metrics = Metrics(metrics.get_number_of_slowest_patients())
+                for counts, shard_metrics in pool.imap(functools.partial(count_drug_condition_pairs_with_metrics, metrics = shard_metrics, **options), shards):
+                    self.merge_count_hash_maps(*counts)
+                    metrics.merge_patients(shard_metrics)
+        finally:
+            pool.close()
+            pool.join()
+
+    def build_approximate_count_hash_maps(self, epsilon = 1e-4, delta = 1e-3, number_of_heavy_hitters = 10000, batch_size = 100000):
+
+        # approximate mode: pair counts go to a Count-Min sketch, only the number_of_heavy_hitters most frequent pairs are kept;
+        # number_of_drug_condition_pair and the drug and condition counts stay exact
+        # a kept pair count is never underestimated and, with probability 1 - delta, overestimated by at most
+        # epsilon * number_of_drug_condition_pair, so its leverage is at most epsilon too high
+        # the counts of an earlier counting are replaced
+        self.__number_of_drug_condition_pair = 0
+        self.__drug_condition_pair_count_hash_map = {}
+        self.__drug_count_hash_map = {}
+        self.__condition_count_hash_map = {}
+        self.__drug_condition_pair_count_arrays = None
+        self.__count_mode = "approximate"
+        counter = ApproximateDrugConditionPairCounter(epsilon, delta, number_of_heavy_hitters, batch_size)
+        for patient_history in self.__patient_histories:
+            for prescription_records, diagnosis_records in patient_history.detect_drug_condition_groups():
+                drug_ids = [self.__drug_vocabulary.intern(x) for x in prescription_records]
+                condition_ids = [self.__condition_vocabulary.intern(x) for x in diagnosis_records]
+                self.__number_of_drug_condition_pair += len(drug_ids) * len(condition_ids)
+                for drug_id in drug_ids:
+                    self.__drug_count_hash_map[drug_id] = self.__drug_count_hash_map.get(drug_id, 0) + len(condition_ids)
+                    high_bits = pack_pair(drug_id, 0)
+                    for condition_id in condition_ids:
+                        counter.add(high_bits | condition_id)
+                for condition_id in condition_ids:
+                    self.__condition_count_hash_map[condition_id] = self.__condition_count_hash_map.get(condition_id, 0) + len(drug_ids)
+        self.__drug_condition_pair_count_hash_map = counter.build_drug_condition_pair_count_hash_map()
+        return counter.get_count_min_sketch()
+
+    def build_count_hash_maps_out_of_core(self, id_medical_records_pairs, directory_path = None, memory_limit = 256 * 1024 * 1024):
+
+        # input: <type: iterable> id_medical_records_pairs: (id, <type: MedicalRecord list>) one patient at a time,
+        #        e.g. iterate_id_medical_records(file_path) or id_medical_records_hash_map.iteritems()
+        #        <type: string> directory_path: where the pair ids are spilled; a temporary directory if None
+        #        <type: int> memory_limit: bytes of pair ids held in memory before they are spilled (see ExternalDrugConditionPairCounter)
+        # out-of-core mode: patient histories are built one at a time and not kept, the pair ids are counted by external sort;
+        # the drug and condition counts stay in memory, they only grow with the vocabularies
+        # build_leverage_hash_map then scores the merged counts; the counts of an earlier counting are replaced
+        with measure_stage(self.__metrics, "build_count_hash_maps_out_of_core"):
+            self.__number_of_drug_condition_pair = 0
+            self.__drug_condition_pair_count_hash_map = {}
+            self.__drug_count_hash_map = {}
+            self.__condition_count_hash_map = {}
+            self.__drug_condition_pair_count_arrays = None
+            self.__count_mode = "out_of_core"
+            counter = ExternalDrugConditionPairCounter(directory_path, memory_limit)
+            for id, medical_records in id_medical_records_pairs:
+                if self.__metrics is not None:
+                    start_time = time.time()
+                    start_number_of_drug_condition_pair = self.__number_of_drug_condition_pair
+                for prescription_records, diagnosis_records in PatientHistory(id, medical_records).detect_drug_condition_groups():
+                    drug_ids = [self.__drug_vocabulary.intern(x) for x in prescription_records]
+                    condition_ids = [self.__condition_vocabulary.intern(x) for x in diagnosis_records]
+                    self.__number_of_drug_condition_pair += len(drug_ids) * len(condition_ids)
+                    for drug_id in drug_ids:
+                        self.__drug_count_hash_map[drug_id] = self.__drug_count_hash_map.get(drug_id, 0) + len(condition_ids)
+                    for condition_id in condition_ids:
+                        self.__condition_count_hash_map[condition_id] = self.__condition_count_hash_map.get(condition_id, 0) + len(drug_ids)
+                    counter.add_drug_condition_pairs(drug_ids, condition_ids)
+                if self.__metrics is not None:
+                    self.__metrics.add_patient(id, len(medical_records), self.__number_of_drug_condition_pair - start_number_of_drug_condition_pair, 
+                                               time.time() - start_time)
+            counter.spill()
+            if self.__metrics is not None:
+                self.__metrics.set_size("spilled_runs", counter.get_number_of_runs())
+            self.__drug_condition_pair_count_arrays = counter.merge()
+        self.record_count_sizes()
+        if self.__metrics is not None:
+            self.__metrics.set_size("drug_condition_pair_count_arrays", len(self.__drug_condition_pair_count_arrays[0]))
+
+    def merge_count_hash_maps(self, number_of_drug_condition_pair, drug_condition_pair_count_hash_map, drug_count_hash_map, condition_count_hash_map, drug_vocabulary, condition_vocabulary):
+
+        # counts keyed by ids of other vocabularies (e.g. from a worker) are re-interned once per distinct code
+        self.check_in_memory_counts()
+        self.__number_of_drug_condition_pair += number_of_drug_condition_pair
+        if drug_vocabulary is self.__drug_vocabulary:
+            drug_ids = None
+        else:
+            drug_ids = [self.__drug_vocabulary.intern(drug) for drug in drug_vocabulary.get_codes()]
+        if condition_vocabulary is self.__condition_vocabulary:
+            condition_ids = None
+        else:
+            condition_ids = [self.__condition_vocabulary.intern(condition) for condition in condition_vocabulary.get_codes()]
+
+        for drug_condition_pair_id, count in drug_condition_pair_count_hash_map.iteritems():
+            if (drug_ids is not None) or (condition_ids is not None):
+                drug_id, condition_id = unpack_pair(drug_condition_pair_id)
+                if drug_ids is not None:
+                    drug_id = drug_ids[drug_id]
+                if condition_ids is not None:
+                    condition_id = condition_ids[condition_id]
+                drug_condition_pair_id = pack_pair(drug_id, condition_id)
+            self.__drug_condition_pair_count_hash_map[drug_condition_pair_id] = self.__drug_condition_pair_count_hash_map.get(drug_condition_pair_id, 0) + count
+        for drug_id, count in drug_count_hash_map.iteritems():
+            if drug_ids is not None:
+                drug_id = drug_ids[drug_id]
+            self.__drug_count_hash_map[drug_id] = self.__drug_count_hash_map.get(drug_id, 0) + count
+        for condition_id, count in condition_count_hash_map.iteritems():
+            if condition_ids is not None:
+                condition_id = condition_ids[condition_id]
+            self.__condition_count_hash_map[condition_id] = self.__condition_count_hash_map.get(condition_id, 0) + count
+
+    def get_top_k_drug_condition_pairs(self, k, group_by = None, min_drug_condition_pair_count = 1, min_drug_count = 1, min_condition_count = 1):
+
+        # input: <type: int> k
+        #        <type: string> group_by: None for the k highest-leverage pairs overall, "drug" or "condition" for k per drug or condition
+        #        <type: int> min_drug_condition_pair_count, min_drug_count, min_condition_count: minimum supports;
+        #                    pairs below them are never scored
+        # output: <type: (drug, condition, leverage) list>, highest leverage first; a dict of such lists keyed by drug or condition if group_by
+        # works on the count hash maps, so build_leverage_hash_map is not needed
         number_of_drug_condition_pair = float(self.__number_of_drug_condition_pair)
-        for drug_condition_pair, drug_condition_pair_count in self.__drug_condition_pair_count_hash_map.items():
-            drug = drug_condition_pair.split(",")[0]
-            condition = drug_condition_pair.split(",")[1]
-            drug_condition_pair_count = float(drug_condition_pair_count)
-            drug_count = float(self.__drug_count_hash_map.get(drug, 0))
-            condition_count = float(self.__condition_count_hash_map.get(condition, 0))
-            leverage = (drug_condition_pair_count/number_of_drug_condition_pair) - (drug_count/number_of_drug_condition_pair)*(condition_count/number_of_drug_condition_pair)
-            self.__drug_condition_pair_leverage_hash_map[drug_condition_pair] = leverage
-            
+        def score_drug_condition_pairs():
+            for drug_condition_pair_id, drug_condition_pair_count in self.iterate_drug_condition_pair_counts():
+                if drug_condition_pair_count < min_drug_condition_pair_count:
+                    continue
+                drug_id, condition_id = unpack_pair(drug_condition_pair_id)
+                drug_count = self.__drug_count_hash_map.get(drug_id, 0)
+                if drug_count < min_drug_count:
+                    continue
+                condition_count = self.__condition_count_hash_map.get(condition_id, 0)
+                if condition_count < min_condition_count:
+                    continue
+                leverage = (float(drug_condition_pair_count)/number_of_drug_condition_pair) - (float(drug_count)/number_of_drug_condition_pair)*(float(condition_count)/number_of_drug_condition_pair)
+                yield leverage, drug_id, condition_id
+
+        drugs = self.__drug_vocabulary.get_codes()
+        conditions = self.__condition_vocabulary.get_codes()
+        if group_by is None:
+            return [(drugs[drug_id], conditions[condition_id], leverage) for leverage, drug_id, condition_id in heapq.nlargest(k, score_drug_condition_pairs())]
+        if group_by == "drug":
+            group_index = 1
+            codes = drugs
+        elif group_by == "condition":
+            group_index = 2
+            codes = conditions
+        else:
+            raise ValueError("group_by must be None, \"drug\" or \"condition\"")
+        if k <= 0:
+            # a group's first pair below is kept without comparing against k
+            return {}
+
+        # key: <type: int> drug_id or condition_id
+        # value: <type: list> min-heap of the k best (leverage, drug_id, condition_id) of the group
+        heaps = {}
+        for scored_drug_condition_pair in score_drug_condition_pairs():
+            heap = heaps.get(scored_drug_condition_pair[group_index], None)
+            if heap is None:
+                heaps[scored_drug_condition_pair[group_index]] = [scored_drug_condition_pair]
+            elif len(heap) < k:
+                heapq.heappush(heap, scored_drug_condition_pair)
+            elif scored_drug_condition_pair > heap[0]:
+                heapq.heapreplace(heap, scored_drug_condition_pair)
+        top_k_drug_condition_pairs = {}
+        for code_id, heap in heaps.items():
+            top_k_drug_condition_pairs[codes[code_id]] = [(drugs[drug_id], conditions[condition_id], leverage) for leverage, drug_id, condition_id in sorted(heap, reverse = True)]
+        return top_k_drug_condition_pairs
+
+    def build_trailing_medical_records_hash_map(self):
+
+        # keep the trailing window of every patient history for update_count_hash_maps
+        self.__id_trailing_medical_records_hash_map.clear()
+        for patient_history in self.__patient_histories:
+            self.__id_trailing_medical_records_hash_map[patient_history.get_id()] = extract_trailing_medical_records(patient_history.get_medical_records())
+
+    def update_count_hash_maps(self, id_medical_records_hash_map):
+
+        # input: <type: dict> id_medical_records_hash_map of a new visit period, later than every visit counted so far
+        # only the prescriptions whose after window reaches the new visits are recounted, from the trailing windows;
+        # call build_leverage_hash_map afterwards; raises ValueError unless the counts so far are exact (see check_exact_counts)
+        self.check_exact_counts()
+        self.check_in_memory_counts()
+        day_delta = datetime.timedelta(days = DAY_DELTA)
+
+        # every patient is checked before any count or trailing window changes, so that a ValueError leaves the state as it was
+        new_patient_histories = []
+        for id, medical_records in id_medical_records_hash_map.items():
+            if len(medical_records) == 0:
+                continue
+            new_patient_history = PatientHistory(id, medical_records)
+            trailing_medical_records = self.__id_trailing_medical_records_hash_map.get(id, None)
+            if (trailing_medical_records is not None) and \
+               (new_patient_history.get_medical_records()[0].get_func_date() <= trailing_medical_records[-1].get_func_date()):
+                raise ValueError("new medical records of %s do not follow the counted ones" % (id))
+            new_patient_histories.append(new_patient_history)
+
+        for new_patient_history in new_patient_histories:
+            id = new_patient_history.get_id()
+            trailing_medical_records = self.__id_trailing_medical_records_hash_map.get(id, None)
+            if trailing_medical_records is None:
+                self.add_drug_condition_groups(new_patient_history.detect_drug_condition_groups())
+            else:
+                start_date = new_patient_history.get_medical_records()[0].get_func_date() - day_delta
+                old_patient_history = PatientHistory(id, trailing_medical_records)
+                self.add_drug_condition_groups(old_patient_history.detect_drug_condition_groups(start_date), -1)
+                new_patient_history = PatientHistory(id, trailing_medical_records + new_patient_history.get_medical_records())
+                self.add_drug_condition_groups(new_patient_history.detect_drug_condition_groups(start_date))
+            self.__id_trailing_medical_records_hash_map[id] = extract_trailing_medical_records(new_patient_history.get_medical_records())
+
+    def add_drug_condition_groups(self, drug_condition_groups, sign = 1):
+
+        # input: <type: generator> drug_condition_groups from PatientHistory.detect_drug_condition_groups
+        #        <type: int> sign: 1 to count the groups, -1 to uncount them
+        for prescription_records, diagnosis_records in drug_condition_groups:
+            self.add_drug_condition_group(prescription_records, diagnosis_records, sign)
+
+    def add_drug_condition_group(self, prescription_records, diagnosis_records, sign = 1):
+        drug_ids = [self.__drug_vocabulary.intern(x) for x in prescription_records]
+        condition_ids = [self.__condition_vocabulary.intern(x) for x in diagnosis_records]
+        self.__number_of_drug_condition_pair += sign * len(drug_ids) * len(condition_ids)
+        for drug_id in drug_ids:
+            add_count(self.__drug_count_hash_map, drug_id, sign * len(condition_ids))
+            for condition_id in condition_ids:
+                add_count(self.__drug_condition_pair_count_hash_map, pack_pair(drug_id, condition_id), sign)
+        for condition_id in condition_ids:
+            add_count(self.__condition_count_hash_map, condition_id, sign * len(drug_ids))
+
+    def build_count_hash_maps_for_windows(self, windows, measures = ("leverage",)):
+
+        # input: <type: (int, int) list> windows: (before_day_delta, after_day_delta) pairs, e.g. [(7, 7), (14, 14), (30, 30)];
+        #        at least one, without duplicates, or ValueError is raised
+        # output: <type: dict> key: window, value: <type: UnexpectedDrugConditionSignal> with its count maps and measures built
+        # every patient history is traversed once for all windows
+        windows = [tuple(x) for x in windows]
+        if len(windows) == 0:
+            raise ValueError("no windows given")
+        if len(set(windows)) != len(windows):
+            raise ValueError("duplicate windows: " + ", ".join(sorted(set([str(x) for x in windows if windows.count(x) > 1]))))
+        udcs_list = [UnexpectedDrugConditionSignal() for x in windows]
+        for patient_history in self.__patient_histories:
+            for prescription_records, diagnosis_records_list in patient_history.detect_drug_condition_groups_for_windows(windows):
+                for udcs, diagnosis_records in zip(udcs_list, diagnosis_records_list):
+                    if len(diagnosis_records) > 0:
+                        udcs.add_drug_condition_group(prescription_records, diagnosis_records)
+        for udcs in udcs_list:
+            udcs.build_leverage_hash_map(measures)
+        return dict(zip(windows, udcs_list))
+
+    def write_incremental_state(self, file_path):
+
+        # save what update_count_hash_maps needs in a later run
+        self.check_exact_counts()
+        with open(file_path, "wb") as file:
+            cPickle.dump((self.__number_of_drug_condition_pair, self.__drug_vocabulary, self.__condition_vocabulary, 
+                          self.__drug_condition_pair_count_hash_map, self.__drug_count_hash_map, self.__condition_count_hash_map, 
+                          self.__id_trailing_medical_records_hash_map), file, cPickle.HIGHEST_PROTOCOL)
+
+    def read_incremental_state(self, file_path):
+        with open(file_path, "rb") as file:
+            (self.__number_of_drug_condition_pair, self.__drug_vocabulary, self.__condition_vocabulary, 
+             self.__drug_condition_pair_count_hash_map, self.__drug_count_hash_map, self.__condition_count_hash_map, 
+             self.__id_trailing_medical_records_hash_map) = cPickle.load(file)
+        self.__drug_condition_pair_count_arrays = None
+        self.__count_mode = "exact"
+
+    def build_count_matrix(self):
+
+        # hold the pair counts as a sparse drug_id x condition_id matrix plus drug and condition count vectors
+        if self.__drug_condition_pair_count_arrays is not None:
+            drug_condition_pair_ids, counts = self.__drug_condition_pair_count_arrays
+        else:
+            number_of_pairs = len(self.__drug_condition_pair_count_hash_map)
+            drug_condition_pair_ids = np.fromiter(self.__drug_condition_pair_count_hash_map.iterkeys(), dtype = np.int64, count = number_of_pairs)
+            counts = np.fromiter(self.__drug_condition_pair_count_hash_map.itervalues(), dtype = np.int64, count = number_of_pairs)
+        shape = (len(self.__drug_vocabulary), len(self.__condition_vocabulary))
+        self.__drug_condition_pair_count_matrix = sparse.csr_matrix((counts, (drug_condition_pair_ids >> CONDITION_ID_BITS, drug_condition_pair_ids & CONDITION_ID_MASK)), shape = shape)
+        self.__drug_count_vector = build_count_vector(self.__drug_count_hash_map, shape[0])
+        self.__condition_count_vector = build_count_vector(self.__condition_count_hash_map, shape[1])
+
+    def build_leverage_hash_map(self, measures = ("leverage",)):
+
+        # measures: names in MEASURES, each computed for all counted drug_condition_pairs at once
+        with measure_stage(self.__metrics, "build_leverage_hash_map"):
+            self.build_count_matrix()
+            matrix = self.__drug_condition_pair_count_matrix.tocoo()
+            pair_counts = matrix.data.astype(np.float64)
+            drug_counts = self.__drug_count_vector[matrix.row]
+            condition_counts = self.__condition_count_vector[matrix.col]
+            number_of_drug_condition_pair = float(self.__number_of_drug_condition_pair)
+            self.__drug_condition_pair_measure_matrix_hash_map.clear()
+            for measure in measures:
+                values = MEASURES[measure](pair_counts, drug_counts, condition_counts, number_of_drug_condition_pair)
+                self.__drug_condition_pair_measure_matrix_hash_map[measure] = sparse.csr_matrix((values, (matrix.row, matrix.col)), shape = matrix.shape)
+        if self.__metrics is not None:
+            self.__metrics.set_size("drug_condition_pair_count_matrix", self.__drug_condition_pair_count_matrix.nnz)
+
+
+def add_count(hash_map, key, delta):
+    count = hash_map.get(key, 0) + delta
+    if count == 0:
+        hash_map.pop(key, None)
+    else:
+        hash_map[key] = count
+
+
+def extract_trailing_medical_records(medical_records):
+
+    # input: <type: MedicalRecord list> medical_records sorted by func_date
+    # output: <type: MedicalRecord list> medical records after the last func_date - 2 * DAY_DELTA days,
+    #         i.e. the before and after windows of every prescription that a later visit can fall into
+    if len(medical_records) == 0:
+        return []
+    start_date = medical_records[-1].get_func_date() - datetime.timedelta(days = 2 * DAY_DELTA)
+    i = len(medical_records)
+    while (i > 0) and (medical_records[i - 1].get_func_date() > start_date):
+        i -= 1
+    return medical_records[i:]
+
+
+def build_count_vector(id_count_hash_map, size):
+    vector = np.zeros(size, dtype = np.float64)
+    vector[np.fromiter(id_count_hash_map.iterkeys(), dtype = np.int64, count = len(id_count_hash_map))] = np.fromiter(id_count_hash_map.itervalues(), dtype = np.float64, count = len(id_count_hash_map))
+    return vector
+
+
+# input: <type: numpy.ndarray> pair_counts, drug_counts, condition_counts (aligned per drug_condition_pair)
+#        <type: float> number_of_drug_condition_pair
+# output: <type: numpy.ndarray> measure per drug_condition_pair
+
+def compute_leverage(pair_counts, drug_counts, condition_counts, number_of_drug_condition_pair):
+    n = number_of_drug_condition_pair
+    return (pair_counts/n) - (drug_counts/n)*(condition_counts/n)
+
+def compute_lift(pair_counts, drug_counts, condition_counts, number_of_drug_condition_pair):
+    n = number_of_drug_condition_pair
+    return (pair_counts/n) / ((drug_counts/n)*(condition_counts/n))
+
+def compute_confidence(pair_counts, drug_counts, condition_counts, number_of_drug_condition_pair):
+    return pair_counts / drug_counts
+
+def compute_chi_square(pair_counts, drug_counts, condition_counts, number_of_drug_condition_pair):
+    # 2x2 contingency table of drug (yes/no) against condition (yes/no)
+    n = number_of_drug_condition_pair
+    a = pair_counts
+    b = drug_counts - pair_counts
+    c = condition_counts - pair_counts
+    d = n - drug_counts - condition_counts + pair_counts
+    denominator = drug_counts * (n - drug_counts) * condition_counts * (n - condition_counts)
+    with np.errstate(divide = "ignore", invalid = "ignore"):
+        chi_square = n * (a*d - b*c)**2 / denominator
+    chi_square[denominator == 0] = 0.0
+    return chi_square
+
+MEASURES = {
+    "leverage": compute_leverage,
+    "lift": compute_lift,
+    "confidence": compute_confidence,
+    "chi_square": compute_chi_square,
+}
+
+
+def count_drug_condition_pairs(patient_histories, drug_vocabulary = None, condition_vocabulary = None, 
+                               count_marginals = True, count_drug_condition_pairs = True, drugs = None, conditions = None, metrics = None):
+
+    # input: <type: PatientHistory list> patient_histories
+    #        <type: Vocabulary> drug_vocabulary, condition_vocabulary: interned into; new ones are created if None
+    #        <type: bool> count_marginals: count number_of_drug_condition_pair and the drug and condition counts
+    #        <type: bool> count_drug_condition_pairs: count the drug_condition_pairs
+    #        <type: frozenset> drugs, conditions: if given, only pairs of these drugs and conditions are counted
+    #        <type: Metrics> metrics: if given, the time, visits and drug_condition_pairs of each patient are recorded into it
+    #                        (the drug_condition_pairs are those added to number_of_drug_condition_pair, so only with count_marginals)
+    # output: <type: tuple> (number_of_drug_condition_pair, drug_condition_pair_count_hash_map, drug_count_hash_map,
+    #                        condition_count_hash_map, drug_vocabulary, condition_vocabulary)
+    # module level so that it can be sent to multiprocessing workers
+    if drug_vocabulary is None:
+        drug_vocabulary = Vocabulary()
+    if condition_vocabulary is None:
+        condition_vocabulary = Vocabulary()
+    number_of_drug_condition_pair = 0
+    drug_condition_pair_count_hash_map = {}
+    drug_count_hash_map = {}
+    condition_count_hash_map = {}
+    for patient_history in patient_histories:
+        if metrics is not None:
+            start_time = time.time()
+            start_number_of_drug_condition_pair = number_of_drug_condition_pair
+        if count_marginals:
+            drug_condition_groups = patient_history.detect_drug_condition_groups()
+        else:
+            # only pairs are counted, so the sweep itself leaves out the other drugs and conditions
+            drug_condition_groups = patient_history.detect_drug_condition_groups(drugs = drugs, conditions = conditions)
+        for prescription_records, diagnosis_records in drug_condition_groups:
+            if count_marginals:
+                drug_ids = [drug_vocabulary.intern(x) for x in prescription_records]
+                condition_ids = [condition_vocabulary.intern(x) for x in diagnosis_records]
+                number_of_drug_condition_pair += len(drug_ids) * len(condition_ids)
+                for drug_id in drug_ids:
+                    drug_count_hash_map[drug_id] = drug_count_hash_map.get(drug_id, 0) + len(condition_ids)
+                for condition_id in condition_ids:
+                    condition_count_hash_map[condition_id] = condition_count_hash_map.get(condition_id, 0) + len(drug_ids)
+            if not count_drug_condition_pairs:
+                continue
+            if count_marginals:
+                if drugs is not None:
+                    prescription_records = [x for x in prescription_records if x in drugs]
+                if conditions is not None:
+                    diagnosis_records = [x for x in diagnosis_records if x in conditions]
+                if (len(prescription_records) == 0) or (len(diagnosis_records) == 0):
+                    continue
+            drug_ids = [drug_vocabulary.intern(x) for x in prescription_records]
+            condition_ids = [condition_vocabulary.intern(x) for x in diagnosis_records]
+            # every drug is paired with every condition of the medical record
+            for drug_id in drug_ids:
+                high_bits = pack_pair(drug_id, 0)
+                for condition_id in condition_ids:
+                    drug_condition_pair_id = high_bits | condition_id
+                    drug_condition_pair_count_hash_map[drug_condition_pair_id] = drug_condition_pair_count_hash_map.get(drug_condition_pair_id, 0) + 1
+        if metrics is not None:
+            metrics.add_patient(patient_history.get_id(), len(patient_history.get_medical_records()), 
+                                number_of_drug_condition_pair - start_number_of_drug_condition_pair, time.time() - start_time)
+    return number_of_drug_condition_pair, drug_condition_pair_count_hash_map, drug_count_hash_map, condition_count_hash_map, drug_vocabulary, condition_vocabulary
+
+
+def count_drug_condition_pairs_with_metrics(patient_histories, metrics, **options):
+
+    # count_drug_condition_pairs for a worker process, which sends back its copy of metrics along with the counts
+    return count_drug_condition_pairs(patient_histories, metrics = metrics, **options), metrics
+
+
+def iterate_arrays_in_chunks(keys, values, chunk_size = 65536):
+
+    # output: <type: generator> (key, value) of aligned numpy arrays as Python ints, converted chunk_size at a time
+    for start in range(0, len(keys), chunk_size):
+        for key_and_value in zip(keys[start:start + chunk_size].tolist(), values[start:start + chunk_size].tolist()):
+            yield key_and_value
 
 
 def write_hash_map_to_file(file_path, hash_map):
@@ -177,6 +909,18 @@ def write_hash_map_to_file(file_path, hash_map):
         file.write(str(key) + "," + str(value) + "\n")
     file.close()
 
+def write_drug_condition_pair_table_to_file(file_path, udcs, measure = None):
+
+    # the lines of write_hash_map_to_file for the pair counts (measure None) or a measure,
+    # streamed one pair at a time, so that out-of-core counts are never held in a dict
+    with open(file_path, "w") as file:
+        if measure is None:
+            drug_condition_pair_values = udcs.iterate_drug_condition_pair_counts()
+        else:
+            drug_condition_pair_values = udcs.iterate_drug_condition_pair_measures(measure)
+        for drug_condition_pair, value in udcs.iterate_drug_condition_pairs(drug_condition_pair_values):
+            file.write(drug_condition_pair + "," + str(value) + "\n")
+
 def write_table_to_file(file_path, hash_map):
     drug_set = set()
     condition_set = set()
@@ -201,37 +945,142 @@ def write_table_to_file(file_path, hash_map):
             file.write(drug + "," + ",".join([str(x) for x in row]) + "\n")
 
 
+def write_matrix_to_file(file_path, matrix, row_names, col_names):
+
+    # same layout as write_table_to_file, produced straight from a sparse matrix:
+    # rows and columns with entries only, sorted by name; cells without an entry are 0
+    matrix = sparse.csr_matrix(matrix)
+    matrix.sort_indices()
+    row_ids = sorted(np.flatnonzero(np.diff(matrix.indptr)).tolist(), key = row_names.__getitem__)
+    col_ids = sorted(np.unique(matrix.indices).tolist(), key = col_names.__getitem__)
+    col_positions = [0] * len(col_names)
+    for position, col_id in enumerate(col_ids):
+        col_positions[col_id] = position
+
+    with open(file_path, "w") as file:
+        file.write("," + ",".join([col_names[x] for x in col_ids]) + "\n")
+        for row_id in row_ids:
+            row = ["0"] * len(col_ids)
+            start = matrix.indptr[row_id]
+            end = matrix.indptr[row_id + 1]
+            for col_id, value in zip(matrix.indices[start:end].tolist(), matrix.data[start:end].tolist()):
+                row[col_positions[col_id]] = str(value)
+            file.write(row_names[row_id] + "," + ",".join(row) + "\n")
+
+
+def write_matrix_to_triplet_file(file_path, matrix, row_names, col_names):
+
+    # one "row_name,col_name,value" line per entry (COO), the layout of write_hash_map_to_file;
+    # values are written with repr() so that they read back exactly
+    matrix = sparse.coo_matrix(matrix)
+    with open(file_path, "w") as file:
+        for row_id, col_id, value in zip(matrix.row.tolist(), matrix.col.tolist(), matrix.data.tolist()):
+            file.write(row_names[row_id] + "," + col_names[col_id] + "," + repr(value) + "\n")
+
+def write_matrix_to_npz_file(file_path, matrix, row_names, col_names):
+
+    # CSR arrays of the matrix with its row and column labels;
+    # saved through an open file, so that np.savez does not append .npz to file_path
+    matrix = sparse.csr_matrix(matrix)
+    with open(file_path, "wb") as file:
+        np.savez(file, data = matrix.data, indices = matrix.indices, indptr = matrix.indptr, shape = np.array(matrix.shape), 
+                 row_names = np.array(row_names, dtype = np.str_), col_names = np.array(col_names, dtype = np.str_))
+
+def write_matrix_to_columnar_file(file_path, matrix, row_names, col_names):
+
+    # compressed row_id, col_id and value columns of the entries with the row and column labels
+    matrix = sparse.coo_matrix(matrix)
+    with open(file_path, "wb") as file:
+        np.savez_compressed(file, row_ids = matrix.row.astype(np.int32), col_ids = matrix.col.astype(np.int32), values = matrix.data, 
+                            shape = np.array(matrix.shape), row_names = np.array(row_names, dtype = np.str_), col_names = np.array(col_names, dtype = np.str_))
+
+LEVERAGE_TABLE_WRITERS = {
+    "dense": write_matrix_to_file,
+    "triplet": write_matrix_to_triplet_file,
+    "npz": write_matrix_to_npz_file,
+    "columnar": write_matrix_to_columnar_file,
+}
+
+def write_leverage_table_to_file(file_path, udcs, file_format = "dense", measure = "leverage"):
+
+    # input: <type: UnexpectedDrugConditionSignal> udcs after build_leverage_hash_map
+    #        <type: string> file_format: "dense", "triplet", "npz" or "columnar"
+    LEVERAGE_TABLE_WRITERS[file_format](file_path, udcs.get_drug_condition_pair_measure_matrix(measure), 
+                                        udcs.get_drug_vocabulary().get_codes(), udcs.get_condition_vocabulary().get_codes())
+
+def read_leverage_table_from_file(file_path, file_format = "dense"):
+
+    # input: <type: string> file_path written by write_leverage_table_to_file with file_format, as given to it
+    # output: <type: dict> key: drug + "," + condition, value: <type: float> leverage
+    hash_map = {}
+    if file_format == "dense":
+        for col_names, row_names, data in file_handler.iterate_csv(file_path):
+            for drug, row in zip(row_names, data):
+                for condition, value in zip(col_names, row):
+                    if value != "0": # cells without an entry
+                        hash_map[drug + "," + condition] = float(value)
+    elif file_format == "triplet":
+        with open(file_path, "r") as file:
+            for line in file:
+                drug_condition_pair, value = line.rstrip("\n").rsplit(",", 1)
+                hash_map[drug_condition_pair] = float(value)
+    elif file_format in ("npz", "columnar"):
+        arrays = np.load(file_path)
+        row_names = arrays["row_names"].tolist()
+        col_names = arrays["col_names"].tolist()
+        if file_format == "npz":
+            matrix = sparse.csr_matrix((arrays["data"], arrays["indices"], arrays["indptr"]), shape = tuple(arrays["shape"])).tocoo()
+            row_ids, col_ids, values = matrix.row, matrix.col, matrix.data
+        else:
+            row_ids, col_ids, values = arrays["row_ids"], arrays["col_ids"], arrays["values"]
+        for row_id, col_id, value in zip(row_ids.tolist(), col_ids.tolist(), values.tolist()):
+            hash_map[row_names[row_id] + "," + col_names[col_id]] = value
+    else:
+        raise ValueError("unknown leverage table format: " + str(file_format))
+    return hash_map
+
 
 if __name__ == "__main__":
     print(__doc__)
     
-    print "fetch data from database"
+    # usage: python DrugConditionSignal.py medical_records_file [memory_limit_in_MB]
+    #        python DrugConditionSignal.py host_address user_name password database_name
+    # with memory_limit_in_MB the medical records are streamed from the file and counted out of core
     start_time = datetime.datetime.now()    
-    lod = LongitudeObservationalDatabase(str(sys.argv[1]), str(sys.argv[2]), str(sys.argv[3]), str(sys.argv[4]))
+    if len(sys.argv) == 3:
+        print "stream data from file"
+        id_medical_records_hash_map = None
+    elif len(sys.argv) == 2:
+        print "read data from file"
+        id_medical_records_hash_map = read_id_medical_records_hash_map(str(sys.argv[1]))
+    else:
+        print "fetch data from database"
+        lod = LongitudeObservationalDatabase(str(sys.argv[1]), str(sys.argv[2]), str(sys.argv[3]), str(sys.argv[4]))
+        id_medical_records_hash_map = lod.get_id_medical_records_hash_map()
     end_time = datetime.datetime.now()
     print (end_time - start_time)
 
     print "detect drug condition pairs"
     start_time = datetime.datetime.now()
     udcs = UnexpectedDrugConditionSignal()    
-    udcs.build_patient_histories(lod.get_id_medical_records_hash_map())
-    udcs.build_count_hash_maps()
+    if id_medical_records_hash_map is None:
+        udcs.build_count_hash_maps_out_of_core(iterate_id_medical_records(str(sys.argv[1])), memory_limit = int(sys.argv[2]) * 1024 * 1024)
+    else:
+        udcs.build_patient_histories(id_medical_records_hash_map)
+        udcs.build_count_hash_maps()
     udcs.build_leverage_hash_map()
     end_time = datetime.datetime.now()
     print (end_time - start_time)
 
     print "write results to files"
     start_time = datetime.datetime.now()
-    write_hash_map_to_file(file_path = "../data/unexpected_drug_condition_pair_count_table.csv", 
-                           hash_map = udcs.get_drug_condition_pair_count_hash_map())
+    write_drug_condition_pair_table_to_file(file_path = "../data/unexpected_drug_condition_pair_count_table.csv", udcs = udcs)
     write_hash_map_to_file(file_path = "../data/unexpected_drug_count_table.csv", 
                            hash_map = udcs.get_drug_count_hash_map())
     write_hash_map_to_file(file_path = "../data/unexpected_condition_count_table.csv", 
                            hash_map = udcs.get_condition_count_hash_map())
-    write_hash_map_to_file(file_path = "../data/unexpected_drug_condition_pair_leverage_table.csv", 
-                           hash_map = udcs.get_drug_condition_pair_leverage_hash_map())
-    write_table_to_file(file_path = "../data/leverage_table.csv", 
-                           hash_map = udcs.get_drug_condition_pair_leverage_hash_map())
+    write_drug_condition_pair_table_to_file(file_path = "../data/unexpected_drug_condition_pair_leverage_table.csv", udcs = udcs, measure = "leverage")
+    write_leverage_table_to_file(file_path = "../data/leverage_table.csv", udcs = udcs)
     end_time = datetime.datetime.now()
     print (end_time - start_time)
     
\ No newline at end of file
@@ -0,0 +1,191 @@
+#!/usr/bin/python
+
+'''
+module name: ExternalSort
+'''
+
+import os
+import heapq
+import shutil
+import tempfile
+import numpy as np
+from itertools import izip
+from Vocabulary import pack_pair
+
+# pair ids are buffered, spilled and memory-mapped as 64-bit ints on every platform (a C long is 32 bits on Windows)
+PAIR_ID_DTYPE = np.dtype(np.int64)
+
+# a buffered pair id takes 8 bytes; sorting and run-length encoding a full buffer takes about three times as much again
+BYTES_PER_BUFFERED_PAIR = 32
+
+# rough size of a (drug_condition_pair_id, count) tuple of Python ints read back from a run during the merge
+BYTES_PER_MERGED_PAIR = 128
+
+# fewest pairs read from a run at a time during the merge; it bounds the number of runs merged at once
+MIN_MERGE_CHUNK_SIZE = 64
+
+
+class ExternalDrugConditionPairCounter:
+
+    # out-of-core drug_condition_pair counting by external sort:
+    # pair ids are buffered up to memory_limit, each full buffer is sorted, run-length encoded and spilled to a run file,
+    # and the runs are k-way merged into the distinct pair ids (ascending) and their counts
+
+    def __init__(self, directory_path = None, memory_limit = 256 * 1024 * 1024):
+
+        # input: <type: string> directory_path: where runs and merged output are written; a temporary directory if None
+        #        <type: int> memory_limit: bytes used by the buffer while counting and by the run chunks while merging
+        self.__is_temporary = directory_path is None
+        if self.__is_temporary:
+            directory_path = tempfile.mkdtemp()
+        elif not os.path.isdir(directory_path):
+            os.makedirs(directory_path)
+        self.__directory_path = directory_path
+        self.__memory_limit = memory_limit
+        self.__capacity = max(1, memory_limit // BYTES_PER_BUFFERED_PAIR)
+
+        # buffered pair ids, filled up to self.__number_of_buffered_pairs
+        self.__drug_condition_pair_ids = np.empty(self.__capacity, dtype = PAIR_ID_DTYPE)
+        self.__number_of_buffered_pairs = 0
+
+        # <type: (string, string) list> pair id and count file of each run
+        self.__run_file_paths = []
+
+        # number of run files ever created, to name the next one
+        self.__number_of_run_file_paths = 0
+
+    def get_directory_path(self):
+        return self.__directory_path
+
+    def get_number_of_runs(self):
+        return len(self.__run_file_paths)
+
+    def add_drug_condition_pairs(self, drug_ids, condition_ids):
+
+        # input: <type: int list> drug_ids, condition_ids: every drug is paired with every condition
+        drug_condition_pair_ids = self.__drug_condition_pair_ids
+        capacity = self.__capacity
+        number_of_buffered_pairs = self.__number_of_buffered_pairs
+        for drug_id in drug_ids:
+            high_bits = pack_pair(drug_id, 0)
+            for condition_id in condition_ids:
+                if number_of_buffered_pairs == capacity:
+                    self.__number_of_buffered_pairs = number_of_buffered_pairs
+                    self.spill()
+                    number_of_buffered_pairs = 0
+                drug_condition_pair_ids[number_of_buffered_pairs] = high_bits | condition_id
+                number_of_buffered_pairs += 1
+        self.__number_of_buffered_pairs = number_of_buffered_pairs
+
+    def spill(self):
+
+        # write the sorted distinct pair ids of the buffer and their counts as a run
+        if self.__number_of_buffered_pairs == 0:
+            return
+        drug_condition_pair_ids, counts = np.unique(self.__drug_condition_pair_ids[:self.__number_of_buffered_pairs], return_counts = True)
+        self.__number_of_buffered_pairs = 0
+        run_file_paths = self.create_run_file_paths()
+        drug_condition_pair_ids.astype(PAIR_ID_DTYPE).tofile(run_file_paths[0])
+        counts.astype(PAIR_ID_DTYPE).tofile(run_file_paths[1])
+        self.__run_file_paths.append(run_file_paths)
+
+    def create_run_file_paths(self):
+        run = self.__number_of_run_file_paths
+        self.__number_of_run_file_paths += 1
+        return (os.path.join(self.__directory_path, "run_%d_drug_condition_pair_ids.bin" % (run)),
+                os.path.join(self.__directory_path, "run_%d_counts.bin" % (run)))
+
+    def merge(self):
+
+        # output: <type: numpy.memmap> drug_condition_pair_ids (ascending, distinct), counts (aligned), read-only
+        # the runs are deleted; with a temporary directory, so is the directory (the memory maps stay readable)
+        self.spill()
+        merged_file_paths = (os.path.join(self.__directory_path, "drug_condition_pair_ids.bin"),
+                             os.path.join(self.__directory_path, "drug_condition_pair_counts.bin"))
+        if len(self.__run_file_paths) == 1:
+            # a single run is already sorted and distinct
+            for run_file_path, merged_file_path in zip(self.__run_file_paths[0], merged_file_paths):
+                os.rename(run_file_path, merged_file_path)
+            del self.__run_file_paths[:]
+            return self.read_merged_files(merged_file_paths, os.path.getsize(merged_file_paths[0]) // PAIR_ID_DTYPE.itemsize)
+
+        # each merged run holds a chunk of at least MIN_MERGE_CHUNK_SIZE pairs in memory, so at most max_fan_in runs are
+        # merged at a time; more runs are first merged max_fan_in at a time into longer runs
+        max_fan_in = max(2, self.__memory_limit // (MIN_MERGE_CHUNK_SIZE * BYTES_PER_MERGED_PAIR))
+        while len(self.__run_file_paths) > max_fan_in:
+            run_file_paths = []
+            for start in range(0, len(self.__run_file_paths), max_fan_in):
+                run_file_paths.append(self.create_run_file_paths())
+                self.merge_runs(self.__run_file_paths[start:start + max_fan_in], run_file_paths[-1])
+            self.__run_file_paths = run_file_paths
+        number_of_pairs = self.merge_runs(self.__run_file_paths, merged_file_paths)
+        self.__run_file_paths = []
+        return self.read_merged_files(merged_file_paths, number_of_pairs)
+
+    def merge_runs(self, run_file_paths, merged_file_paths):
+
+        # input: <type: (string, string) list> run_file_paths: pair id and count file of each run, deleted once merged
+        #        <type: (string, string)> merged_file_paths: pair id and count file of the merged run
+        # output: <type: int> number of distinct pairs merged
+        # the memory limit is shared by the chunk read from each run and the chunk of merged pairs written
+        chunk_size = max(MIN_MERGE_CHUNK_SIZE, self.__memory_limit // ((len(run_file_paths) + 1) * BYTES_PER_MERGED_PAIR))
+        runs = [iterate_run(drug_condition_pair_ids_file_path, counts_file_path, chunk_size)
+                for drug_condition_pair_ids_file_path, counts_file_path in run_file_paths]
+        number_of_pairs = 0
+        drug_condition_pair_ids = np.empty(chunk_size, dtype = PAIR_ID_DTYPE)
+        counts = np.empty(chunk_size, dtype = PAIR_ID_DTYPE)
+        i = -1
+        last_drug_condition_pair_id = None
+        with open(merged_file_paths[0], "wb") as drug_condition_pair_ids_file:
+            with open(merged_file_paths[1], "wb") as counts_file:
+                for drug_condition_pair_id, count in heapq.merge(*runs):
+                    if drug_condition_pair_id == last_drug_condition_pair_id:
+                        counts[i] += count
+                        continue
+                    i += 1
+                    if i == chunk_size:
+                        # the runs are merged in order, so the buffered pairs are complete
+                        drug_condition_pair_ids.tofile(drug_condition_pair_ids_file)
+                        counts.tofile(counts_file)
+                        number_of_pairs += chunk_size
+                        i = 0
+                    drug_condition_pair_ids[i] = drug_condition_pair_id
+                    counts[i] = count
+                    last_drug_condition_pair_id = drug_condition_pair_id
+                drug_condition_pair_ids[:i + 1].tofile(drug_condition_pair_ids_file)
+                counts[:i + 1].tofile(counts_file)
+                number_of_pairs += i + 1
+
+        for file_paths in run_file_paths:
+            for file_path in file_paths:
+                os.remove(file_path)
+        return number_of_pairs
+
+    def read_merged_files(self, merged_file_paths, number_of_pairs):
+        merged_arrays = tuple([read_pair_id_file(x, number_of_pairs) for x in merged_file_paths])
+        if self.__is_temporary:
+            shutil.rmtree(self.__directory_path)
+        return merged_arrays
+
+
+def iterate_run(drug_condition_pair_ids_file_path, counts_file_path, chunk_size):
+
+    # output: <type: generator> (drug_condition_pair_id, count) of a run in ascending order, read chunk_size at a time
+    # the files are read rather than memory-mapped, so that pages already merged do not stay resident
+    with open(drug_condition_pair_ids_file_path, "rb") as drug_condition_pair_ids_file:
+        with open(counts_file_path, "rb") as counts_file:
+            while True:
+                drug_condition_pair_ids = np.fromfile(drug_condition_pair_ids_file, dtype = PAIR_ID_DTYPE, count = chunk_size)
+                if len(drug_condition_pair_ids) == 0:
+                    break
+                counts = np.fromfile(counts_file, dtype = PAIR_ID_DTYPE, count = chunk_size)
+                for drug_condition_pair_id_and_count in izip(drug_condition_pair_ids.tolist(), counts.tolist()):
+                    yield drug_condition_pair_id_and_count
+
+
+def read_pair_id_file(file_path, size):
+
+    # np.memmap cannot map an empty file
+    if size == 0:
+        return np.zeros(0, dtype = PAIR_ID_DTYPE)
+    return np.memmap(file_path, dtype = PAIR_ID_DTYPE, mode = "r", shape = (size,))
@@ -1,39 +1,84 @@
 #!/usr/bin/python
 
 import csv
+import numpy as np
 
-def read_csv(file_path, has_header = True, has_row_names = True, are_numerical_data = False):
+def iterate_csv(file_path, has_header = True, has_row_names = True, are_numerical_data = False,
+                chunk_size = 10000, converters = None, dtype = None, convert = None):
+
+    # input: <type: int> chunk_size: maximum number of rows per chunk
+    #        <type: function list> converters: exactly one per data column, e.g. [str, int]; a row of another length raises ValueError
+    #        <type: function> convert: one function for every data column, e.g. float; int if are_numerical_data
+    #        <type: numpy.dtype> dtype: if given, the data of a chunk is a numpy array of dtype
+    # output: <type: generator> (col_names, row_names, data) per chunk, parsed in one pass over the file
     col_names = []
-    row_names = []
-    data = []
-    with open(file_path, "r") as f:
-        spamreader = csv.reader(f, delimiter=',', quotechar='\"')
-        if has_header:
-            row = spamreader.next()
-            row = row[1:]
-            row = [x.strip() for x in row]
-            col_names.extend(row)
     with open(file_path, "r") as f:
         spamreader = csv.reader(f, delimiter = ',', quotechar = '\"')
         if has_header:
-            next(spamreader, None)
-        if has_row_names:
-            for row in spamreader:
+            row = next(spamreader, [])
+            row = row[1:]
+            col_names.extend([x.strip() for x in row])
+        if converters is not None:
+            if convert is not None:
+                raise ValueError("give either converters or convert")
+            converters = list(converters)
+        elif (convert is None) and are_numerical_data:
+            convert = int
+        row_names = []
+        data = []
+        for row in spamreader:
+            if has_row_names:
                 row_names.append(row[0].strip())
                 row = row[1:]
+            if converters is not None:
+                if len(converters) != len(row):
+                    raise ValueError("%s: %d converters for a row of %d data columns" % (file_path, len(converters), len(row)))
+                row = [converter(x.strip()) for converter, x in zip(converters, row)]
+            elif convert is not None:
+                row = [convert(x.strip()) for x in row]
+            else:
                 row = [x.strip() for x in row]
-                data.append(row)
-        else:
-            for row in spamreader:
-                row = [x.strip() for x in row]
-                data.append(row)
-	if are_numerical_data:
-            data = [[int(x) for x in row] for row in data]
+            data.append(row)
+            if len(data) == chunk_size:
+                yield col_names, row_names, to_chunk(data, dtype)
+                row_names = []
+                data = []
+        if len(data) > 0:
+            yield col_names, row_names, to_chunk(data, dtype)
+
+def to_chunk(data, dtype):
+    if dtype is None:
+        return data
+    return np.array(data).astype(dtype)
+
+def read_csv(file_path, has_header = True, has_row_names = True, are_numerical_data = False):
+    col_names = []
+    row_names = []
+    data = []
+    for chunk_col_names, chunk_row_names, chunk_data in iterate_csv(file_path, has_header, has_row_names, are_numerical_data):
+        col_names = chunk_col_names
+        row_names.extend(chunk_row_names)
+        data.extend(chunk_data)
+    if has_header and (len(col_names) == 0):
+        col_names = read_csv_header(file_path)
     return col_names, row_names, data
 
+def read_csv_header(file_path):
+    with open(file_path, "r") as f:
+        row = next(csv.reader(f, delimiter = ',', quotechar = '\"'), [])
+    return [x.strip() for x in row[1:]]
+
 def write_csv(file_path, data, header = None, row_names = None):
-    with open(file_path, "w") as f:
-        f.write("," + ",".join(header) + "\n")
-        for i in range(0, len(data), 1):
-            f.write(row_names[i] + "," + ",".join([str(x) for x in data[i]]) + "\n")
 
+    # rows go through csv.writer in bulk; cells are written with str() as before
+    with open(file_path, "w") as f:
+        spamwriter = csv.writer(f, delimiter = ',', quotechar = '\"', lineterminator = "\n")
+        if header is not None:
+            if row_names is None:
+                spamwriter.writerow(header)
+            else:
+                spamwriter.writerow([""] + list(header))
+        if row_names is None:
+            spamwriter.writerows([str(x) for x in row] for row in data)
+        else:
+            spamwriter.writerows([row_names[i]] + [str(x) for x in data[i]] for i in range(0, len(data), 1))
@@ -0,0 +1,209 @@
+#!/usr/bin/python
+
+'''
+module name: Metrics
+'''
+
+import os
+import json
+import time
+import heapq
+import cProfile
+import numpy as np
+from array import array
+
+
+class Metrics:
+
+    # opt-in instrumentation of LongitudeObservationalDatabase and UnexpectedDrugConditionSignal:
+    # pass a Metrics as their metrics argument; with metrics = None (the default) nothing is recorded
+
+    def __init__(self, number_of_slowest_patients = 10, profile = False):
+
+        self.__number_of_slowest_patients = number_of_slowest_patients
+
+        # <type: dict list> wall and CPU time of each stage, in order of completion
+        self.__stages = []
+        self.__depth = 0
+
+        # key: <type: string> table_name
+        # value: <type: dict> rows fetched and wall time of the table load
+        self.__table_hash_map = {}
+
+        # visits and drug_condition_pairs of each counted patient
+        self.__numbers_of_visits = array("l")
+        self.__numbers_of_drug_condition_pairs = array("l")
+
+        # min-heap of the number_of_slowest_patients slowest patients: (seconds, id, number_of_visits, number_of_drug_condition_pairs)
+        self.__slowest_patients = []
+
+        # key: <type: string> name of a hash map
+        # value: <type: int> number of entries
+        self.__size_hash_map = {}
+
+        # cProfile.Profile enabled during the outermost stages if profile
+        self.__profiler = None
+        if profile:
+            self.__profiler = cProfile.Profile()
+
+    def get_number_of_slowest_patients(self):
+        return self.__number_of_slowest_patients
+
+    def get_stages(self):
+        return self.__stages
+
+    def get_table_hash_map(self):
+        return self.__table_hash_map
+
+    def get_size_hash_map(self):
+        return self.__size_hash_map
+
+    def get_slowest_patients(self):
+
+        # output: <type: tuple list> (seconds, id, number_of_visits, number_of_drug_condition_pairs), slowest first
+        return sorted(self.__slowest_patients, reverse = True)
+
+    def measure(self, stage_name):
+        return Stage(self, stage_name)
+
+    def start_stage(self):
+
+        # output: <type: tuple> start wall time and os.times()
+        if (self.__depth == 0) and (self.__profiler is not None):
+            self.__profiler.enable()
+        self.__depth += 1
+        return time.time(), os.times()
+
+    def end_stage(self, stage_name, start):
+        end_times = os.times()
+        end_time = time.time()
+        self.__depth -= 1
+        if (self.__depth == 0) and (self.__profiler is not None):
+            self.__profiler.disable()
+        start_time, start_times = start
+        self.__stages.append({
+            "stage": stage_name,
+            "depth": self.__depth,
+            "wall_seconds": end_time - start_time,
+            "cpu_seconds": (end_times[0] - start_times[0]) + (end_times[1] - start_times[1]),
+            "child_cpu_seconds": (end_times[2] - start_times[2]) + (end_times[3] - start_times[3]),
+        })
+
+    def add_table(self, table_name, number_of_rows, seconds):
+
+        # called once per table, possibly from the loader threads
+        self.__table_hash_map[table_name] = {"rows": number_of_rows, "wall_seconds": seconds}
+
+    def add_patient(self, id, number_of_visits, number_of_drug_condition_pairs, seconds):
+        self.__numbers_of_visits.append(number_of_visits)
+        self.__numbers_of_drug_condition_pairs.append(number_of_drug_condition_pairs)
+        self.add_slowest_patient((seconds, id, number_of_visits, number_of_drug_condition_pairs))
+
+    def merge_patients(self, metrics):
+
+        # input: <type: Metrics> metrics of a shard counted by a worker process
+        self.__numbers_of_visits.extend(metrics.__numbers_of_visits)
+        self.__numbers_of_drug_condition_pairs.extend(metrics.__numbers_of_drug_condition_pairs)
+        for slowest_patient in metrics.__slowest_patients:
+            self.add_slowest_patient(slowest_patient)
+
+    def add_slowest_patient(self, slowest_patient):
+        if len(self.__slowest_patients) < self.__number_of_slowest_patients:
+            heapq.heappush(self.__slowest_patients, slowest_patient)
+        elif slowest_patient[0] > self.__slowest_patients[0][0]:
+            heapq.heapreplace(self.__slowest_patients, slowest_patient)
+
+    def set_size(self, name, size):
+        self.__size_hash_map[name] = size
+
+    def __getstate__(self):
+
+        # only the patient metrics are pickled, to and from the worker processes; a copy has no profiler
+        return self.__number_of_slowest_patients, self.__numbers_of_visits, self.__numbers_of_drug_condition_pairs, self.__slowest_patients
+
+    def __setstate__(self, state):
+        self.__init__(state[0])
+        self.__numbers_of_visits, self.__numbers_of_drug_condition_pairs, self.__slowest_patients = state[1:]
+
+    def build_report(self):
+
+        # output: <type: dict> stages, tables, patients and sizes, ready for json
+        return {
+            "stages": self.__stages,
+            "tables": self.__table_hash_map,
+            "patients": {
+                "count": len(self.__numbers_of_visits),
+                "visits": summarize(self.__numbers_of_visits),
+                "drug_condition_pairs": summarize(self.__numbers_of_drug_condition_pairs),
+                "slowest": [{"id": id, "seconds": seconds, "visits": number_of_visits, "drug_condition_pairs": number_of_drug_condition_pairs}
+                            for seconds, id, number_of_visits, number_of_drug_condition_pairs in self.get_slowest_patients()],
+            },
+            "sizes": self.__size_hash_map,
+        }
+
+    def write_report(self, file_path):
+        with open(file_path, "w") as file:
+            json.dump(self.build_report(), file, indent = 2, sort_keys = True)
+
+    def write_profile(self, file_path):
+
+        # cProfile dump of the outermost stages, for pstats or snakeviz; only with profile = True
+        if self.__profiler is None:
+            raise ValueError("profiling is not enabled")
+        self.__profiler.dump_stats(file_path)
+
+
+class Stage:
+
+    # context manager timing one stage into a Metrics
+
+    def __init__(self, metrics, stage_name):
+        self.__metrics = metrics
+        self.__stage_name = stage_name
+        self.__start = None
+
+    def __enter__(self):
+        self.__start = self.__metrics.start_stage()
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.__metrics.end_stage(self.__stage_name, self.__start)
+        return False
+
+
+class NullStage:
+
+    # what measure_stage() returns when metrics is None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        return False
+
+NULL_STAGE = NullStage()
+
+
+def measure_stage(metrics, stage_name):
+
+    # input: <type: Metrics> metrics, may be None
+    # output: context manager timing stage_name into metrics, a no-op if metrics is None
+    if metrics is None:
+        return NULL_STAGE
+    return metrics.measure(stage_name)
+
+
+def summarize(values):
+
+    # output: <type: dict> total, mean, max and percentiles of values; None if there are no values
+    if len(values) == 0:
+        return None
+    values = np.frombuffer(values, dtype = np.dtype(values.typecode)) if isinstance(values, array) else np.asarray(values)
+    return {
+        "total": int(values.sum()),
+        "mean": float(values.mean()),
+        "max": int(values.max()),
+        "p50": float(np.percentile(values, 50)),
+        "p90": float(np.percentile(values, 90)),
+        "p99": float(np.percentile(values, 99)),
+    }
@@ -4,34 +4,74 @@
 module name: ObservationalData
 '''
 
+import os
 import sys
+import json
+import hashlib
 import MySQLdb
+import MySQLdb.connections
+import MySQLdb.cursors
 import datetime
+import time
+import Queue
+import numpy as np
+from array import array
+from multiprocessing.pool import ThreadPool
+from operator import methodcaller
+from Vocabulary import Vocabulary
+from Metrics import measure_stage
+
+
+# key: <type: string or datetime> func_date as fetched or read
+# value: <type: datetime.date> func_date shared by all medical records of that day (a datetime.datetime is kept as is)
+FUNC_DATE_HASH_MAP = {}
+
+
+def intern_func_date(func_date):
+
+    shared_func_date = FUNC_DATE_HASH_MAP.get(func_date, None)
+    if shared_func_date is None:
+        if isinstance(func_date, basestring):
+            if (len(func_date) == 10) and (func_date[4] == "-") and (func_date[7] == "-"):
+                # zero-padded "%Y-%m-%d", the usual case, parsed without strptime
+                shared_func_date = datetime.date(int(func_date[0:4]), int(func_date[5:7]), int(func_date[8:10]))
+            else:
+                shared_func_date = datetime.datetime.strptime(func_date, "%Y-%m-%d").date()
+        else:
+            shared_func_date = func_date
+        shared_func_date = FUNC_DATE_HASH_MAP.setdefault(shared_func_date, shared_func_date)
+        FUNC_DATE_HASH_MAP[func_date] = shared_func_date
+    return shared_func_date
 
 
-class MedicalRecord:
+class MedicalRecord(object):
     
+    # no instance dict: an id, a shared datetime.date and two sorted tuples of codes per visit
+    __slots__ = ("__id", "__func_date", "__prescription_records", "__diagnosis_records")
 
     def __init__(self, id, func_date, prescription_records = None, diagnosis_records = None):
         
+        if type(id) is str:
+            id = intern(id)
         self.__id = id
         
-        if type(func_date) is str:
-            self.__func_date = datetime.datetime.strptime(func_date, "%Y-%m-%d")
-        elif type(func_date) is datetime.date:
-            self.__func_date = func_date
-        elif type(func_date) is datetime.datetime:
-            self.__func_date = func_date
+        self.__func_date = intern_func_date(func_date)
 
         if prescription_records == None:
-            self.__prescription_records = set()
+            self.__prescription_records = ()
         else:
-            self.__prescription_records = set(prescription_records)
+            self.__prescription_records = tuple(sorted(set(prescription_records)))
 
         if diagnosis_records == None:
-            self.__diagnosis_records = set()
+            self.__diagnosis_records = ()
         else:
-            self.__diagnosis_records = set(diagnosis_records)
+            self.__diagnosis_records = tuple(sorted(set(diagnosis_records)))
+
+    def __getstate__(self):
+        return self.__id, self.__func_date, self.__prescription_records, self.__diagnosis_records
+
+    def __setstate__(self, state):
+        self.__id, self.__func_date, self.__prescription_records, self.__diagnosis_records = state
 
     def __str__(self):
         line = ",".join(self.__prescription_records) + " | " + ",".join(self.__diagnosis_records)
@@ -51,31 +91,37 @@ class MedicalRecord:
     
     def add_prescription_record(self, prescription_record):
         
-        self.__prescription_records.add(prescription_record)
+        if prescription_record not in self.__prescription_records:
+            self.__prescription_records = tuple(sorted(self.__prescription_records + (prescription_record,)))
     
     
     def add_diagnosis_record(self, diagnosis_record):
         
-        self.__diagnosis_records.add(diagnosis_record)
+        if diagnosis_record not in self.__diagnosis_records:
+            self.__diagnosis_records = tuple(sorted(self.__diagnosis_records + (diagnosis_record,)))
     
 
     def extend_prescription_records(self, prescription_records):
         
-        for prescription_record in prescription_records:
-            self.__prescription_records.add(prescription_record)
+        self.__prescription_records = tuple(sorted(set(self.__prescription_records).union(prescription_records)))
 
 
     def extend_diagnosis_records(self, diagnosis_records):
         
-        for diagnosis_record in diagnosis_records:
-            self.__diagnosis_records.add(diagnosis_record)
+        self.__diagnosis_records = tuple(sorted(set(self.__diagnosis_records).union(diagnosis_records)))
 
     
     def write(self, file_path):
         with open(file_path, "a") as file:
-            file.write(self.__id + "," + str(self.__func_date.strftime('%Y-%m-%d')) + "\n")
-            file.write(",".join(sorted(self.__prescription_records)) + "\n")
-            file.write(",".join(sorted(self.__diagnosis_records)) + "\n") 
+            self.write_to_file(file)
+
+
+    def write_to_file(self, file):
+
+        # three lines: id,func_date / prescription_records / diagnosis_records
+        file.write(self.__id + "," + str(self.__func_date.strftime('%Y-%m-%d')) + "\n" + 
+                   ",".join(self.__prescription_records) + "\n" + 
+                   ",".join(self.__diagnosis_records) + "\n")
     
     
     def display(self):
@@ -85,17 +131,127 @@ class MedicalRecord:
 
 
 
+class CodeTranslationHashMap(dict):
+
+    # memo of translate_code over raw cells: a cell not seen before is translated once, on its first lookup
+    # key: <type: string> raw cell as fetched
+    # value: <type: string> translated code; None if the code is not mapped
+
+    def __init__(self, translate_code):
+        dict.__init__(self)
+        self.__translate_code = translate_code
+
+    def __missing__(self, code):
+        translated_code = self.__translate_code(code)
+        self[code] = translated_code
+        return translated_code
+
+
+def write_medical_records(file_path, medical_records):
+
+    # input: <type: string> file_path
+    #        <type: MedicalRecord iterable> medical_records, written through one buffered file handle
+    with open(file_path, "w") as file:
+        for medical_record in medical_records:
+            medical_record.write_to_file(file)
+
+
+def write_id_medical_records_hash_map(file_path, id_medical_records_hash_map):
+
+    # patients are written one after another, each in func_date order
+    write_medical_records(file_path, (medical_record for id in sorted(id_medical_records_hash_map.keys())
+                                      for medical_record in sorted(id_medical_records_hash_map[id], key = methodcaller('get_func_date'))))
+
+
+def read_medical_records(file_path):
+
+    # input: <type: string> file_path written by write_medical_records or MedicalRecord.write
+    # output: <type: generator> MedicalRecord
+    with open(file_path, "r") as file:
+        lines = iter(file)
+        for line in lines:
+            id, func_date = line.rstrip("\n").split(",")
+            prescription_records = next(lines).rstrip("\n")
+            diagnosis_records = next(lines).rstrip("\n")
+            if len(prescription_records) > 0:
+                prescription_records = prescription_records.split(",")
+            else:
+                prescription_records = None
+            if len(diagnosis_records) > 0:
+                diagnosis_records = diagnosis_records.split(",")
+            else:
+                diagnosis_records = None
+            # func_date strings are parsed once per distinct date by intern_func_date
+            yield MedicalRecord(id, func_date, prescription_records, diagnosis_records)
+
+
+def iterate_id_medical_records(file_path):
+
+    # input: <type: string> file_path written by write_id_medical_records_hash_map, i.e. with the records of a patient together
+    # output: <type: generator> (id, <type: MedicalRecord list>), one patient at a time
+    ids = set()
+    id = None
+    medical_records = []
+    for medical_record in read_medical_records(file_path):
+        if medical_record.get_id() != id:
+            if len(medical_records) > 0:
+                yield id, medical_records
+            id = medical_record.get_id()
+            if id in ids:
+                raise ValueError("medical records of %s are not together in %s" % (id, file_path))
+            ids.add(id)
+            medical_records = []
+        medical_records.append(medical_record)
+    if len(medical_records) > 0:
+        yield id, medical_records
+
+
+def read_id_medical_records_hash_map(file_path):
+
+    # output: <type: dict> id_medical_records_hash_map, as LongitudeObservationalDatabase builds it
+    id_medical_records_hash_map = {}
+    for medical_record in read_medical_records(file_path):
+        id = medical_record.get_id()
+        medical_records = id_medical_records_hash_map.get(id, None)
+        if medical_records is None:
+            medical_records = []
+            id_medical_records_hash_map[id] = medical_records
+        medical_records.append(medical_record)
+    return id_medical_records_hash_map
+
+
+
 class LongitudeObservationalDatabase:
     
-    def __init__(self, host_address = None, user_name = None, password = None, database_name = None):
+    def __init__(self, host_address = None, user_name = None, password = None, database_name = None, batch_size = None, 
+                 years = None, group_nos = None, number_of_connections = 1, snapshot_path = None, metrics = None):
         
         self.__host_address = host_address
         self.__user_name = user_name
         self.__password = password
         self.__database_name = database_name
         self.__database = None
-        self.__years = [x for x in range(2004, 2009, 1)]
-        self.__group_nos = [20]
+        if years is None:
+            self.__years = [x for x in range(2004, 2009, 1)]
+        else:
+            self.__years = list(years)
+        if group_nos is None:
+            self.__group_nos = [20]
+        else:
+            self.__group_nos = list(group_nos)
+
+        # size of the connection pool used to fetch the Ambutory tables concurrently, one query per table in flight
+        self.__number_of_connections = number_of_connections
+
+        # directory of the columnar snapshot of self.__id_medical_records_hash_map; None: no snapshot
+        self.__snapshot_path = snapshot_path
+
+        # <type: Metrics> stage times, rows per table and hash map sizes are recorded into it; None: not instrumented
+        self.__metrics = metrics
+
+        # number of rows per fetchmany() when streaming the Ambutory tables
+        # None: fetch each table at once with fetchall()
+        self.__batch_size = batch_size
 
         # key: <type: string> drug_no
         # value : <type: string> atc_code
@@ -108,13 +264,24 @@ class LongitudeObservationalDatabase:
         # key: <type: string> icd9cm
         # value : <type: string> umls_cid
         self.__icd9cm_umls_cid_hash_map = {}
+
+        # key: <type: string> drug_no
+        # value : <type: string> medDRA, i.e. drug_no -> atc_code -> medDRA in one lookup
+        self.__drug_no_medDRA_hash_map = {}
+
+        # memos of the translation of raw Drug_No and ACode_ICD9 cells as fetched (not stripped nor normalized)
+        # key: <type: string> raw cell
+        # value : <type: string> medDRA or umls_cid; None if the code is not mapped
+        self.__raw_drug_no_medDRA_hash_map = CodeTranslationHashMap(self.translate_drug_no)
+        self.__raw_acode_icd9_umls_cid_hash_map = CodeTranslationHashMap(self.translate_acode_icd9)
         
-        # key: <type: string> id + "," + str(func_date)
+        # key: <type: tuple> (id, func_date as fetched)
         # value : <type: MedicalRecord>
+        # only used while loading; each MedicalRecord is also in self.__id_medical_records_hash_map
         self.__id_func_date_medical_record_hash_map = {}
         
         # key: <type: string> id
-        # value: <type: MedicalRecord>
+        # value: <type: MedicalRecord list>
         self.__id_medical_records_hash_map = {}
 
         if (self.__host_address is not None) and (self.__user_name is not None) and (self.__password is not None) and (self.__database_name is not None):
@@ -123,28 +290,102 @@ class LongitudeObservationalDatabase:
     def get_id_medical_records_hash_map(self):
         return self.__id_medical_records_hash_map
 
+    def get_metrics(self):
+        return self.__metrics
+
+    def connect(self):
+
+        # output: <type: DB-API connection>
+        # override to read from another DB-API database (e.g. sqlite3) with the same tables
+        return MySQLdb.connect(host = self.__host_address, 
+                               user = self.__user_name, 
+                               passwd = self.__password, 
+                               db = self.__database_name)
+
     def set_up(self):
 
-        self.__database = MySQLdb.connect(host = self.__host_address, 
-		                     user = self.__user_name, 
-		                     passwd = self.__password, 
-		                     db = self.__database_name)
-        self.build_drug_no_atc_code_hash_map()
-        self.build_atc_code_medDRA_hash_map()
-        self.build_icd9cm_umls_cid_hash_map()
+        self.__database = self.connect()
+        if self.__snapshot_path is not None:
+            with measure_stage(self.__metrics, "read_snapshot"):
+                snapshot_key = self.build_snapshot_key()
+                id_medical_records_hash_map = read_snapshot(self.__snapshot_path, snapshot_key)
+            if id_medical_records_hash_map is not None:
+                self.__id_medical_records_hash_map = id_medical_records_hash_map
+                self.record_sizes()
+                return
+        with measure_stage(self.__metrics, "build_code_hash_maps"):
+            self.build_drug_no_atc_code_hash_map()
+            self.build_atc_code_medDRA_hash_map()
+            self.build_icd9cm_umls_cid_hash_map()
+            self.build_drug_no_medDRA_hash_map()
         self.__id_func_date_medical_record_hash_map.clear() # clear self.__id_func_date_medical_record_hash_map
-        self.add_prescription_records_to_id_func_date_medical_record_hash_map()
-        self.add_diagnosis_records_to_id_func_date_medical_record_hash_map()
-        self.build_id_medical_records_hash_map()
+        self.__id_medical_records_hash_map.clear()
+        with measure_stage(self.__metrics, "load_prescription_records"):
+            self.add_prescription_records_to_id_func_date_medical_record_hash_map()
+        with measure_stage(self.__metrics, "load_diagnosis_records"):
+            self.add_diagnosis_records_to_id_func_date_medical_record_hash_map()
+        self.record_sizes()
+        self.__id_func_date_medical_record_hash_map.clear() # records are grouped by patient while loading
+        # only reached once every table has loaded: fetch_data_in_batches raises on a table it cannot read,
+        # and the snapshot key does not cover the Ambutory table contents, so a partial cohort must never be written
+        if self.__snapshot_path is not None:
+            with measure_stage(self.__metrics, "write_snapshot"):
+                write_snapshot(self.__snapshot_path, snapshot_key, self.__id_medical_records_hash_map)
+
+
+    def record_sizes(self):
+
+        # number of entries of the hash maps built by set_up
+        if self.__metrics is None:
+            return
+        self.__metrics.set_size("drug_no_medDRA_hash_map", len(self.__drug_no_medDRA_hash_map))
+        self.__metrics.set_size("icd9cm_umls_cid_hash_map", len(self.__icd9cm_umls_cid_hash_map))
+        self.__metrics.set_size("raw_drug_no_medDRA_hash_map", len(self.__raw_drug_no_medDRA_hash_map))
+        self.__metrics.set_size("raw_acode_icd9_umls_cid_hash_map", len(self.__raw_acode_icd9_umls_cid_hash_map))
+        self.__metrics.set_size("id_func_date_medical_record_hash_map", len(self.__id_func_date_medical_record_hash_map))
+        self.__metrics.set_size("id_medical_records_hash_map", len(self.__id_medical_records_hash_map))
+        self.__metrics.set_size("medical_records", sum([len(x) for x in self.__id_medical_records_hash_map.itervalues()]))
+
+
+    def build_snapshot_key(self):
+
+        # output: <type: string> sha1 of the source table list and the checksums of the code mapping tables
+        # the Ambutory tables are keyed by name only; a snapshot is stale once the table list or a mapping table changes
+        table_names = []
+        for year in self.__years:
+            for group_no in self.__group_nos:
+                table_names.append("Ambutory_OO" + str(year) + "_R" + str(group_no) + "_Full")
+                table_names.append("Ambutory_CD" + str(year) + "_R" + str(group_no))
+        key = hashlib.sha1(",".join(table_names))
+        for table_name in ["Drug_Description", "ATCCode_MedDRA", "ICD9CM_UMLSCID"]:
+            key.update("," + table_name + ":" + self.fetch_table_checksum(table_name))
+        return key.hexdigest()
+
+
+    def fetch_table_checksum(self, table_name):
+
+        # input: <type: string> table_name
+        # output: <type: string> checksum of the table content
+        if isinstance(self.__database, MySQLdb.connections.Connection):
+            sql_results = self.fetch_data("CHECKSUM TABLE " + table_name)
+            return str(sql_results[0][1])
+        # other DB-API databases have no CHECKSUM TABLE; hash the rows instead
+        checksum = hashlib.sha1()
+        for row in sorted(self.fetch_data("SELECT * FROM " + table_name)):
+            checksum.update(repr(row))
+        return checksum.hexdigest()
     
     
-    def fetch_data(self, sql):
+    def fetch_data(self, sql, database = None):
         
         # input: <type: string> sql
+        #        <type: DB-API connection> database: self.__database if None
         # output: <type: tuple list> sql_results
         
+        if database is None:
+            database = self.__database
         try:
-            cursor = self.__database.cursor()
+            cursor = database.cursor()
             cursor.execute(sql)
             sql_results = cursor.fetchall()
             cursor.close()
@@ -155,6 +396,40 @@ class LongitudeObservationalDatabase:
             print "Error! Cannot fetch data."
     
     
+    def fetch_data_in_batches(self, sql, database = None):
+
+        # input: <type: string> sql
+        #        <type: DB-API connection> database: self.__database if None
+        # output: <type: generator> <type: tuple list> sql_results of at most self.__batch_size rows
+        # MySQL rows are streamed through an unbuffered server-side cursor,
+        # so memory depends on self.__batch_size instead of the table size
+        # None: the whole table is one batch; a failed query raises
+
+        if database is None:
+            database = self.__database
+
+        if isinstance(database, MySQLdb.connections.Connection) and (self.__batch_size is not None):
+            cursor = database.cursor(MySQLdb.cursors.SSCursor)
+        else:
+            cursor = database.cursor()
+        try:
+            cursor.execute(sql)
+            if self.__batch_size is None:
+                yield cursor.fetchall()
+                return
+            while True:
+                sql_results = cursor.fetchmany(self.__batch_size)
+                if len(sql_results) == 0:
+                    break
+                yield sql_results
+        except Exception:
+            # a table that cannot be read must not leave a partial cohort behind (nor a snapshot of it)
+            print "Error! Cannot fetch data."
+            raise
+        finally:
+            cursor.close()
+    
+    
     def build_drug_no_atc_code_hash_map(self):
     	
         # fetch drug code raw data
@@ -200,61 +475,174 @@ class LongitudeObservationalDatabase:
         	self.__icd9cm_umls_cid_hash_map[icd9cm] = umls_cid
 
 
+    def build_drug_no_medDRA_hash_map(self):
+
+        # compose self.__drug_no_atc_code_hash_map and self.__atc_code_medDRA_hash_map
+        self.__drug_no_medDRA_hash_map.clear()
+        self.__raw_drug_no_medDRA_hash_map.clear()
+        self.__raw_acode_icd9_umls_cid_hash_map.clear()
+        for drug_no, atc_code in self.__drug_no_atc_code_hash_map.items():
+            medDRA = self.__atc_code_medDRA_hash_map.get(atc_code, None)
+            if medDRA is not None:
+                self.__drug_no_medDRA_hash_map[drug_no] = medDRA
+
+
+    def translate_drug_no(self, drug_no):
+
+        # input: <type: string> raw Drug_No
+        # output: <type: string> medDRA; None if not mapped
+        return self.__drug_no_medDRA_hash_map.get(drug_no.strip(), None)
+
+
+    def translate_acode_icd9(self, acode_icd9):
+
+        # input: <type: string> raw ACode_ICD9, e.g. "V7231" or "4011"
+        # output: <type: string> umls_cid of the ICD9CM code, e.g. "V72.31" or "401.1"; None if empty or not mapped
+        acode_icd9 = acode_icd9.strip()
+        if len(acode_icd9) == 0:
+            return None
+        if acode_icd9[0] == "E" or acode_icd9[0] == "V":
+            acode_icd9 = acode_icd9[0:4] + "." + acode_icd9[4:]
+        else:
+            acode_icd9 = acode_icd9[0:3] + "." + acode_icd9[3:]
+        return self.__icd9cm_umls_cid_hash_map.get(acode_icd9, None)
+
+
     def add_prescription_records_to_id_func_date_medical_record_hash_map(self):
 
+        table_names = []
         for year in self.__years:
             for group_no in self.__group_nos:
-                
-                table_name = "Ambutory_OO" + str(year) + "_R" + str(group_no) + "_Full"
-                # fetch prescription raw data
-                sql = "SELECT ID, Func_Date, Drug_No FROM " + table_name
-    	        sql_results = self.fetch_data(sql)
-                
-                # put keys and values to self.__id_func_date_medical_record_hash_map
-    	        for row in sql_results:
-                    drug_no = row[2].strip()
-                    atc_code = self.__drug_no_atc_code_hash_map.get(drug_no, None)
-                    if atc_code is None:
-                        continue
-                    medDRA = self.__atc_code_medDRA_hash_map.get(atc_code, None)
-                    if medDRA is None:
-                        continue
-                    id = row[0].strip()
-                    func_date = row[1]
-                    key = id + "," + str(func_date)
-                    medical_record = self.__id_func_date_medical_record_hash_map.get(key, MedicalRecord(id, func_date))
-                    medical_record.add_prescription_record(medDRA) # medDRA
-                    self.__id_func_date_medical_record_hash_map[key] = medical_record    
+                table_names.append("Ambutory_OO" + str(year) + "_R" + str(group_no) + "_Full")
+        self.load_tables(self.add_prescription_records_in_table, table_names)
 
 
     def add_diagnosis_records_to_id_func_date_medical_record_hash_map(self):
 
+        table_names = []
         for year in self.__years:
             for group_no in self.__group_nos:
-                
-                table_name = "Ambutory_CD" + str(year) + "_R" + str(group_no)
-                # fetch diagnosis raw data
-                sql = "SELECT ID, Func_Date, ACode_ICD9_1, ACode_ICD9_2, ACode_ICD9_3 FROM " + table_name
-    	        sql_results = self.fetch_data(sql)
-                
-                # put keys and values to self.__id_func_date_medical_record_hash_map
-    	        for row in sql_results:
-                    id = row[0].strip()
-                    func_date = row[1]
-                    key = id + "," + str(func_date)
-                    medical_record = self.__id_func_date_medical_record_hash_map.get(key, MedicalRecord(id, func_date))
-                    for i in range(2, 5, 1):
-                        acode_icd9 = row[i].strip() # acode_icd9
-                        if len(acode_icd9) > 0:
-						    if acode_icd9[0] == "E" or acode_icd9[0] == "V":
-						        acode_icd9 = acode_icd9[0:4] + "." + acode_icd9[4:]
-						    else:
-						        acode_icd9 = acode_icd9[0:3] + "." + acode_icd9[3:]
-						    umls_cid = self.__icd9cm_umls_cid_hash_map.get(acode_icd9, None)
-						    if umls_cid is not None:
-						        medical_record.add_diagnosis_record(umls_cid)
-                    #print str(medical_record)
-                    self.__id_func_date_medical_record_hash_map[key] = medical_record    
+                table_names.append("Ambutory_CD" + str(year) + "_R" + str(group_no))
+        self.load_tables(self.add_diagnosis_records_in_table, table_names)
+
+
+    def load_tables(self, add_records_in_table, table_names):
+
+        # input: <type: function> add_records_in_table(table_name, database, id_func_date_medical_record_hash_map, id_medical_records_hash_map),
+        #                                returning the number of rows fetched
+        #        <type: string list> table_names
+        # with self.__number_of_connections > 1, the tables are fetched by a thread pool over a connection pool,
+        # each into its own hash maps, and merged into self.__id_func_date_medical_record_hash_map in table order
+
+        number_of_connections = min(self.__number_of_connections, len(table_names))
+        if number_of_connections <= 1:
+            for table_name in table_names:
+                self.load_table(add_records_in_table, table_name, self.__database, self.__id_func_date_medical_record_hash_map, self.__id_medical_records_hash_map)
+            return
+
+        connection_pool = Queue.Queue()
+        connection_pool.put(self.__database)
+        extra_connections = [self.connect() for i in range(1, number_of_connections, 1)]
+        for database in extra_connections:
+            connection_pool.put(database)
+
+        def fetch_table(table_name):
+            database = connection_pool.get()
+            try:
+                id_func_date_medical_record_hash_map = {}
+                self.load_table(add_records_in_table, table_name, database, id_func_date_medical_record_hash_map, {})
+                return id_func_date_medical_record_hash_map
+            finally:
+                connection_pool.put(database)
+
+        thread_pool = ThreadPool(processes = number_of_connections)
+        try:
+            # imap yields in table order, so the merge does not depend on which query finishes first
+            for id_func_date_medical_record_hash_map in thread_pool.imap(fetch_table, table_names):
+                self.merge_id_func_date_medical_record_hash_map(id_func_date_medical_record_hash_map)
+        finally:
+            thread_pool.close()
+            thread_pool.join()
+            for database in extra_connections:
+                database.close()
+
+
+    def load_table(self, add_records_in_table, table_name, database, id_func_date_medical_record_hash_map, id_medical_records_hash_map):
+
+        # add_records_in_table, timed into self.__metrics with the number of rows fetched
+        start_time = time.time()
+        number_of_rows = add_records_in_table(table_name, database, id_func_date_medical_record_hash_map, id_medical_records_hash_map)
+        if self.__metrics is not None:
+            self.__metrics.add_table(table_name, number_of_rows, time.time() - start_time)
+
+
+    def merge_id_func_date_medical_record_hash_map(self, id_func_date_medical_record_hash_map):
+
+        for key, medical_record in id_func_date_medical_record_hash_map.items():
+            merged_medical_record = self.__id_func_date_medical_record_hash_map.get(key, None)
+            if merged_medical_record is None:
+                self.__id_func_date_medical_record_hash_map[key] = medical_record
+                self.add_medical_record_to_id_medical_records_hash_map(medical_record)
+            else:
+                merged_medical_record.extend_prescription_records(medical_record.get_prescription_records())
+                merged_medical_record.extend_diagnosis_records(medical_record.get_diagnosis_records())
+
+
+    def add_prescription_records_in_table(self, table_name, database, id_func_date_medical_record_hash_map, id_medical_records_hash_map):
+
+        # input: <type: dict> id_func_date_medical_record_hash_map: key: (id, func_date), value: MedicalRecord
+        #        <type: dict> id_medical_records_hash_map: key: id, value: MedicalRecord list, extended with each new MedicalRecord
+        # output: <type: int> number of rows fetched
+        # fetch prescription raw data
+        sql = "SELECT ID, Func_Date, Drug_No FROM " + table_name
+        medDRA_hash_map = self.__raw_drug_no_medDRA_hash_map
+
+        # put keys and values to id_func_date_medical_record_hash_map
+        number_of_rows = 0
+        for sql_results in self.fetch_data_in_batches(sql, database):
+            number_of_rows += len(sql_results)
+            # each distinct Drug_No is translated once per run, later rows cost a single lookup
+            for id, func_date, drug_no in sql_results:
+                medDRA = medDRA_hash_map[drug_no]
+                if medDRA is None:
+                    continue
+                id = id.strip()
+                key = (id, func_date)
+                medical_record = id_func_date_medical_record_hash_map.get(key, None)
+                if medical_record is None:
+                    medical_record = MedicalRecord(id, func_date)
+                    id_func_date_medical_record_hash_map[key] = medical_record
+                    id_medical_records_hash_map.setdefault(id, []).append(medical_record)
+                medical_record.add_prescription_record(medDRA) # medDRA
+        return number_of_rows
+
+
+    def add_diagnosis_records_in_table(self, table_name, database, id_func_date_medical_record_hash_map, id_medical_records_hash_map):
+
+        # input: <type: dict> id_func_date_medical_record_hash_map: key: (id, func_date), value: MedicalRecord
+        #        <type: dict> id_medical_records_hash_map: key: id, value: MedicalRecord list, extended with each new MedicalRecord
+        # output: <type: int> number of rows fetched
+        # fetch diagnosis raw data
+        sql = "SELECT ID, Func_Date, ACode_ICD9_1, ACode_ICD9_2, ACode_ICD9_3 FROM " + table_name
+        umls_cid_hash_map = self.__raw_acode_icd9_umls_cid_hash_map
+
+        # put keys and values to id_func_date_medical_record_hash_map
+        number_of_rows = 0
+        for sql_results in self.fetch_data_in_batches(sql, database):
+            number_of_rows += len(sql_results)
+            # each distinct ACode_ICD9 is normalized and translated once per run, later cells cost a single lookup
+            for id, func_date, acode_icd9_1, acode_icd9_2, acode_icd9_3 in sql_results:
+                id = id.strip()
+                key = (id, func_date)
+                medical_record = id_func_date_medical_record_hash_map.get(key, None)
+                if medical_record is None:
+                    medical_record = MedicalRecord(id, func_date)
+                    id_func_date_medical_record_hash_map[key] = medical_record
+                    id_medical_records_hash_map.setdefault(id, []).append(medical_record)
+                for umls_cid in (umls_cid_hash_map[acode_icd9_1], umls_cid_hash_map[acode_icd9_2], umls_cid_hash_map[acode_icd9_3]):
+                    if umls_cid is not None:
+                        medical_record.add_diagnosis_record(umls_cid)
+        return number_of_rows
     
     
     def add_medical_record_to_id_medical_records_hash_map(self, medical_record):
@@ -265,18 +653,108 @@ class LongitudeObservationalDatabase:
         self.__id_medical_records_hash_map[id] = medical_records    
     
     
-    def build_id_medical_records_hash_map(self):
-        
-        # extract keys and values from self.__id_func_date_medical_record_hash_map
-        # change keys from (id + "," + func_date) into id
-        # put keys and values to self.__id_func_date_medical_record_hash_map
-        for id_func_date, medical_record in self.__id_func_date_medical_record_hash_map.items():
-            id = id_func_date.split(",")[0]
-            medical_records = self.__id_medical_records_hash_map.get(id, [])
-            medical_records.append(medical_record)
-            self.__id_medical_records_hash_map[id] = medical_records
-    
-    
+
+# a snapshot is a directory of .npy arrays plus metadata.json, written last:
+#   patient_ids       <type: string>                     one per patient
+#   visit_offsets     <type: int64>  len(patient_ids) + 1, patient i owns visits [visit_offsets[i], visit_offsets[i + 1])
+#   func_days         <type: int32>                      func_date of each visit as a proleptic Gregorian ordinal
+#   drug_offsets      <type: int64>  len(func_days) + 1, visit j owns drug_ids[drug_offsets[j]:drug_offsets[j + 1]]
+#   drug_ids          <type: int32>                      index into drug_codes
+#   condition_offsets <type: int64>  len(func_days) + 1
+#   condition_ids     <type: int32>                      index into condition_codes
+#   drug_codes        <type: string>                     MedDRA codes
+#   condition_codes   <type: string>                     UMLS codes
+SNAPSHOT_FORMAT_VERSION = 1
+SNAPSHOT_ARRAY_NAMES = ["patient_ids", "visit_offsets", "func_days", "drug_offsets", "drug_ids", 
+                        "condition_offsets", "condition_ids", "drug_codes", "condition_codes"]
+
+
+def write_snapshot(directory_path, snapshot_key, id_medical_records_hash_map):
+
+    # input: <type: string> directory_path
+    #        <type: string> snapshot_key, compared by read_snapshot to detect stale data
+    #        <type: dict> id_medical_records_hash_map
+    if not os.path.isdir(directory_path):
+        os.makedirs(directory_path)
+    metadata_path = os.path.join(directory_path, "metadata.json")
+    if os.path.exists(metadata_path):
+        os.remove(metadata_path)
+
+    drug_vocabulary = Vocabulary()
+    condition_vocabulary = Vocabulary()
+    patient_ids = sorted(id_medical_records_hash_map.keys())
+    visit_offsets = array("l", [0])
+    func_days = array("i")
+    drug_offsets = array("l", [0])
+    drug_ids = array("i")
+    condition_offsets = array("l", [0])
+    condition_ids = array("i")
+    for id in patient_ids:
+        for medical_record in sorted(id_medical_records_hash_map[id], key = methodcaller('get_func_date')):
+            func_days.append(medical_record.get_func_date().toordinal())
+            drug_ids.extend([drug_vocabulary.intern(x) for x in sorted(medical_record.get_prescription_records())])
+            drug_offsets.append(len(drug_ids))
+            condition_ids.extend([condition_vocabulary.intern(x) for x in sorted(medical_record.get_diagnosis_records())])
+            condition_offsets.append(len(condition_ids))
+        visit_offsets.append(len(func_days))
+
+    arrays = {
+        "patient_ids": np.array(patient_ids, dtype = np.str_),
+        "visit_offsets": np.array(visit_offsets, dtype = np.int64),
+        "func_days": np.array(func_days, dtype = np.int32),
+        "drug_offsets": np.array(drug_offsets, dtype = np.int64),
+        "drug_ids": np.array(drug_ids, dtype = np.int32),
+        "condition_offsets": np.array(condition_offsets, dtype = np.int64),
+        "condition_ids": np.array(condition_ids, dtype = np.int32),
+        "drug_codes": np.array(drug_vocabulary.get_codes(), dtype = np.str_),
+        "condition_codes": np.array(condition_vocabulary.get_codes(), dtype = np.str_),
+    }
+    for name in SNAPSHOT_ARRAY_NAMES:
+        np.save(os.path.join(directory_path, name + ".npy"), arrays[name])
+    with open(metadata_path, "w") as file:
+        json.dump({"format_version": SNAPSHOT_FORMAT_VERSION, "snapshot_key": snapshot_key}, file)
+
+
+def read_snapshot(directory_path, snapshot_key):
+
+    # input: <type: string> directory_path
+    #        <type: string> snapshot_key
+    # output: <type: dict> id_medical_records_hash_map; None if there is no complete snapshot for snapshot_key
+    metadata_path = os.path.join(directory_path, "metadata.json")
+    if not os.path.exists(metadata_path):
+        return None
+    with open(metadata_path, "r") as file:
+        metadata = json.load(file)
+    if (metadata.get("format_version") != SNAPSHOT_FORMAT_VERSION) or (metadata.get("snapshot_key") != snapshot_key):
+        return None
+
+    arrays = {}
+    for name in SNAPSHOT_ARRAY_NAMES:
+        arrays[name] = np.load(os.path.join(directory_path, name + ".npy"), mmap_mode = "r")
+    drug_codes = arrays["drug_codes"].tolist()
+    condition_codes = arrays["condition_codes"].tolist()
+    visit_offsets = arrays["visit_offsets"]
+    drug_offsets = arrays["drug_offsets"]
+    condition_offsets = arrays["condition_offsets"]
+
+    id_medical_records_hash_map = {}
+    for i, id in enumerate(arrays["patient_ids"].tolist()):
+        visit_start = visit_offsets[i]
+        visit_end = visit_offsets[i + 1]
+        func_days = arrays["func_days"][visit_start:visit_end].tolist()
+        patient_drug_offsets = drug_offsets[visit_start:visit_end + 1].tolist()
+        patient_drug_ids = arrays["drug_ids"][patient_drug_offsets[0]:patient_drug_offsets[-1]].tolist()
+        patient_condition_offsets = condition_offsets[visit_start:visit_end + 1].tolist()
+        patient_condition_ids = arrays["condition_ids"][patient_condition_offsets[0]:patient_condition_offsets[-1]].tolist()
+        medical_records = []
+        for j, func_day in enumerate(func_days):
+            prescription_records = [drug_codes[x] for x in patient_drug_ids[patient_drug_offsets[j] - patient_drug_offsets[0]:patient_drug_offsets[j + 1] - patient_drug_offsets[0]]]
+            diagnosis_records = [condition_codes[x] for x in patient_condition_ids[patient_condition_offsets[j] - patient_condition_offsets[0]:patient_condition_offsets[j + 1] - patient_condition_offsets[0]]]
+            medical_records.append(MedicalRecord(id, datetime.date.fromordinal(func_day), prescription_records, diagnosis_records))
+        id_medical_records_hash_map[id] = medical_records
+    return id_medical_records_hash_map
+
+
         
 if __name__ == "__main__":
     print(__doc__)
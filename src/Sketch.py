@@ -0,0 +1,215 @@
+#!/usr/bin/python
+
+'''
+module name: Sketch
+'''
+
+import sys
+import math
+import heapq
+import datetime
+import numpy as np
+from Vocabulary import CONDITION_ID_BITS
+from Vocabulary import CONDITION_ID_MASK
+
+# Mersenne prime 2^31 - 1 for the row hashes (a * x + b) mod PRIME
+PRIME = (1 << 31) - 1
+
+
+class CountMinSketch:
+
+    # Count-Min sketch of drug_condition_pair counts (Cormode and Muthukrishnan, 2005)
+    # with width = ceil(e / epsilon) and depth = ceil(ln(1 / delta)), an estimate is never below the true count
+    # and exceeds it by at most epsilon * (total count added) with probability at least 1 - delta
+
+    def __init__(self, epsilon = 1e-4, delta = 1e-3, seed = 0):
+
+        self.__width = int(math.ceil(math.e / epsilon))
+        self.__depth = int(math.ceil(math.log(1.0 / delta)))
+        self.__epsilon = epsilon
+        self.__delta = delta
+        self.__total_count = 0
+        self.__table = np.zeros((self.__depth, self.__width), dtype = np.int64)
+
+        # per row hash coefficients for drug_id, condition_id and the offset
+        random_state = np.random.RandomState(seed)
+        self.__drug_coefficients = random_state.randint(1, PRIME, size = self.__depth).astype(np.uint64)
+        self.__condition_coefficients = random_state.randint(1, PRIME, size = self.__depth).astype(np.uint64)
+        self.__offsets = random_state.randint(0, PRIME, size = self.__depth).astype(np.uint64)
+
+    def get_width(self):
+        return self.__width
+
+    def get_depth(self):
+        return self.__depth
+
+    def get_total_count(self):
+        return self.__total_count
+
+    def get_error_bound(self):
+
+        # output: <type: float> additive error bound epsilon * total_count, holding with probability 1 - delta
+        return self.__epsilon * self.__total_count
+
+    def get_number_of_bytes(self):
+        return self.__table.nbytes
+
+    def hash(self, drug_condition_pair_ids, row):
+
+        # input: <type: numpy.ndarray> drug_condition_pair_ids packed by pack_pair
+        # output: <type: numpy.ndarray> column of each drug_condition_pair in the row
+        drug_ids = (drug_condition_pair_ids >> CONDITION_ID_BITS).astype(np.uint64)
+        condition_ids = (drug_condition_pair_ids & CONDITION_ID_MASK).astype(np.uint64)
+        prime = np.uint64(PRIME)
+        hashes = (self.__drug_coefficients[row] * drug_ids) % prime
+        hashes = (hashes + (self.__condition_coefficients[row] * condition_ids) % prime + self.__offsets[row]) % prime
+        return (hashes % np.uint64(self.__width)).astype(np.int64)
+
+    def add(self, drug_condition_pair_ids, counts):
+
+        # input: <type: numpy.ndarray> drug_condition_pair_ids, counts (aligned)
+        self.__total_count += int(counts.sum())
+        for row in range(0, self.__depth, 1):
+            self.__table[row] += np.bincount(self.hash(drug_condition_pair_ids, row), weights = counts, minlength = self.__width).astype(np.int64)
+
+    def estimate(self, drug_condition_pair_ids):
+
+        # input: <type: numpy.ndarray> drug_condition_pair_ids
+        # output: <type: numpy.ndarray> estimated count of each drug_condition_pair
+        estimates = self.__table[0][self.hash(drug_condition_pair_ids, 0)]
+        for row in range(1, self.__depth, 1):
+            estimates = np.minimum(estimates, self.__table[row][self.hash(drug_condition_pair_ids, row)])
+        return estimates
+
+
+class HeavyHitters:
+
+    # the capacity drug_condition_pairs with the highest estimated counts seen so far
+
+    def __init__(self, capacity):
+
+        if capacity < 1:
+            raise ValueError("at least one heavy hitter must be kept, not %d" % (capacity))
+        self.__capacity = capacity
+
+        # key: <type: int> drug_condition_pair_id
+        # value: <type: int> estimated count
+        self.__estimate_hash_map = {}
+
+        # min-heap of (estimated count, drug_condition_pair_id); entries whose estimate has changed are stale
+        self.__heap = []
+
+    def get_estimate_hash_map(self):
+        return self.__estimate_hash_map
+
+    def update(self, drug_condition_pair_ids, estimates):
+
+        # input: <type: int list> drug_condition_pair_ids, estimates (aligned)
+        for drug_condition_pair_id, estimate in zip(drug_condition_pair_ids, estimates):
+            if drug_condition_pair_id in self.__estimate_hash_map:
+                self.__estimate_hash_map[drug_condition_pair_id] = estimate
+                heapq.heappush(self.__heap, (estimate, drug_condition_pair_id))
+                continue
+            if len(self.__estimate_hash_map) >= self.__capacity:
+                minimum = self.peek_minimum()
+                if estimate <= minimum[0]:
+                    continue
+                heapq.heappop(self.__heap)
+                del self.__estimate_hash_map[minimum[1]]
+            self.__estimate_hash_map[drug_condition_pair_id] = estimate
+            heapq.heappush(self.__heap, (estimate, drug_condition_pair_id))
+        if len(self.__heap) > 4 * self.__capacity:
+            self.__heap = [(estimate, drug_condition_pair_id) for drug_condition_pair_id, estimate in self.__estimate_hash_map.iteritems()]
+            heapq.heapify(self.__heap)
+
+    def peek_minimum(self):
+
+        # output: the (estimate, drug_condition_pair_id) with the lowest current estimate; stale heap entries are dropped
+        while self.__estimate_hash_map.get(self.__heap[0][1], None) != self.__heap[0][0]:
+            heapq.heappop(self.__heap)
+        return self.__heap[0]
+
+
+class ApproximateDrugConditionPairCounter:
+
+    # Count-Min sketch of the pair counts plus heavy hitters; pair ids are buffered and added to the sketch in batches
+
+    def __init__(self, epsilon = 1e-4, delta = 1e-3, number_of_heavy_hitters = 10000, batch_size = 100000):
+
+        self.__count_min_sketch = CountMinSketch(epsilon, delta)
+        self.__heavy_hitters = HeavyHitters(number_of_heavy_hitters)
+        self.__batch_size = batch_size
+        self.__drug_condition_pair_ids = []
+
+    def get_count_min_sketch(self):
+        return self.__count_min_sketch
+
+    def add(self, drug_condition_pair_id):
+        self.__drug_condition_pair_ids.append(drug_condition_pair_id)
+        if len(self.__drug_condition_pair_ids) >= self.__batch_size:
+            self.flush()
+
+    def add_counts(self, drug_condition_pair_ids, counts):
+
+        # input: <type: numpy.ndarray> drug_condition_pair_ids (distinct), counts
+        self.__count_min_sketch.add(drug_condition_pair_ids, counts)
+        self.__heavy_hitters.update(drug_condition_pair_ids.tolist(), self.__count_min_sketch.estimate(drug_condition_pair_ids).tolist())
+
+    def flush(self):
+        if len(self.__drug_condition_pair_ids) == 0:
+            return
+        drug_condition_pair_ids, counts = np.unique(np.array(self.__drug_condition_pair_ids, dtype = np.int64), return_counts = True)
+        self.__drug_condition_pair_ids = []
+        self.add_counts(drug_condition_pair_ids, counts)
+
+    def build_drug_condition_pair_count_hash_map(self):
+
+        # output: <type: dict> key: drug_condition_pair_id of a heavy hitter, value: <type: int> estimated count
+        self.flush()
+        drug_condition_pair_ids = np.array(sorted(self.__heavy_hitters.get_estimate_hash_map().keys()), dtype = np.int64)
+        return dict(zip(drug_condition_pair_ids.tolist(), self.__count_min_sketch.estimate(drug_condition_pair_ids).tolist()))
+
+
+
+if __name__ == "__main__":
+    print(__doc__)
+
+    # benchmark approximate mode (build_approximate_count_hash_maps) against exact mode (build_count_hash_maps)
+    # on the shipped medical records; the small batch_size and number_of_heavy_hitters exercise batching and eviction
+    from ObservationalData import read_id_medical_records_hash_map
+    from DrugConditionSignal import UnexpectedDrugConditionSignal
+    medical_records_file_path = "../data/test_medical_records.csv"
+    if len(sys.argv) > 1:
+        medical_records_file_path = str(sys.argv[1])
+    batch_size = 64
+    number_of_heavy_hitters = 200
+    top_k = 50
+    id_medical_records_hash_map = read_id_medical_records_hash_map(medical_records_file_path)
+
+    start_time = datetime.datetime.now()
+    exact_udcs = UnexpectedDrugConditionSignal()
+    exact_udcs.build_patient_histories(id_medical_records_hash_map)
+    exact_udcs.build_count_hash_maps()
+    exact_udcs.build_leverage_hash_map()
+    end_time = datetime.datetime.now()
+    exact_count_hash_map = exact_udcs.get_drug_condition_pair_count_hash_map()
+    exact_leverage_hash_map = exact_udcs.get_drug_condition_pair_leverage_hash_map()
+    exact_top_k = set([(drug + "," + condition) for drug, condition, leverage in exact_udcs.get_top_k_drug_condition_pairs(top_k)])
+    print "exact: %d pairs, %d drug_condition_pair occurrences, %s" % (len(exact_count_hash_map), exact_udcs.get_number_of_drug_condition_pair(), end_time - start_time)
+
+    for epsilon in [1e-1, 1e-2, 1e-3]:
+        start_time = datetime.datetime.now()
+        udcs = UnexpectedDrugConditionSignal()
+        udcs.build_patient_histories(id_medical_records_hash_map)
+        sketch = udcs.build_approximate_count_hash_maps(epsilon = epsilon, delta = 1e-3, number_of_heavy_hitters = number_of_heavy_hitters, batch_size = batch_size)
+        udcs.build_leverage_hash_map()
+        end_time = datetime.datetime.now()
+        count_hash_map = udcs.get_drug_condition_pair_count_hash_map()
+        leverage_hash_map = udcs.get_drug_condition_pair_leverage_hash_map()
+        count_errors = [count_hash_map[x] - exact_count_hash_map[x] for x in count_hash_map]
+        leverage_errors = [abs(leverage_hash_map[x] - exact_leverage_hash_map[x]) for x in leverage_hash_map]
+        top_k_drug_condition_pairs = set([(drug + "," + condition) for drug, condition, leverage in udcs.get_top_k_drug_condition_pairs(top_k)])
+        print "epsilon %g: %dx%d sketch (%d bytes), %d heavy hitters, count error %d to %d (bound %.1f), max leverage error %.2e (bound %.2e), top-%d recall %.2f, %s" % (
+            epsilon, sketch.get_depth(), sketch.get_width(), sketch.get_number_of_bytes(), len(count_hash_map),
+            min(count_errors), max(count_errors), sketch.get_error_bound(), max(leverage_errors), epsilon, top_k,
+            len(exact_top_k & top_k_drug_condition_pairs) / float(top_k), end_time - start_time)
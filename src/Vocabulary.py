@@ -0,0 +1,58 @@
+#!/usr/bin/python
+
+'''
+module name: Vocabulary
+'''
+
+
+class Vocabulary:
+
+    def __init__(self, codes = None):
+
+        # key: <type: string> code (MedDRA or UMLS)
+        # value: <type: int> code_id
+        self.__code_id_hash_map = {}
+
+        # index: <type: int> code_id
+        # value: <type: string> code
+        self.__codes = []
+
+        if codes is not None:
+            for code in codes:
+                self.intern(code)
+
+    def __len__(self):
+        return len(self.__codes)
+
+    def get_codes(self):
+        return self.__codes
+
+    def get_code(self, code_id):
+        return self.__codes[code_id]
+
+    def get_code_id(self, code):
+        return self.__code_id_hash_map.get(code, None)
+
+    def intern(self, code):
+
+        # input: <type: string> code
+        # output: <type: int> code_id, assigned densely in order of first appearance
+        code_id = self.__code_id_hash_map.get(code, None)
+        if code_id is None:
+            code_id = len(self.__codes)
+            self.__code_id_hash_map[code] = code_id
+            self.__codes.append(code)
+        return code_id
+
+
+# a drug_condition_pair is packed into one int: drug_id in the high 32 bits, condition_id in the low 32 bits
+CONDITION_ID_BITS = 32
+CONDITION_ID_MASK = (1 << CONDITION_ID_BITS) - 1
+
+
+def pack_pair(drug_id, condition_id):
+    return (drug_id << CONDITION_ID_BITS) | condition_id
+
+
+def unpack_pair(drug_condition_pair_id):
+    return drug_condition_pair_id >> CONDITION_ID_BITS, drug_condition_pair_id & CONDITION_ID_MASK